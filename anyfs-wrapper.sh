@@ -24,4 +24,9 @@ for ((IDX=1; IDX <= $#; ++IDX)); do
     fi
 done
 
+if [[ -n "$ANYFSD_SOCKET" ]]; then
+    OTHERARGS=("$WRAPPERPROG" "${OTHERARGS[@]}")
+    APIHANDLERPROG="$(which anyfsc.py)"
+fi
+
 "$ANYFSPROG" "${ANYFSARGS[@]}" -c "$APIHANDLERPROG" "${OTHERARGS[@]}"
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+
+from anyfscollection import client
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect anyfs to a handler hosted by anyfsd")
+    parser.add_argument("-s", "--socket", help="Unix socket of anyfsd",
+                        default=os.environ.get("ANYFSD_SOCKET", client.socketpath()))
+    parser.add_argument("handler", help="Handler name, e.g. rutube.py")
+    parser.add_argument("args", help="Handler arguments", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    client.connect(args.socket, args.handler, args.args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class DiskCache:
+    SUFFIX = ".entry"
+    RESCAN = 10.0
+
+    def __init__(self, directory, maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def key(url, headers=None):
+        parts = [url, *sorted(f"{k.lower()}:{v}" for k, v in (headers or {}).items())]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def _scan(self):
+        self._sizes = {}
+        self._scanned = time.monotonic()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                try:
+                    self._sizes[entry.name] = entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def load(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # evicted by another thread or mount right after the read
+            pass
+
+        return meta, body
+
+    def store(self, key, meta, body):
+        self._write(key, [json.dumps(meta).encode() + b"\n", body])
+
+    def _write(self, key, chunks):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+            size = f.tell()
+
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self._sizes[key + self.SUFFIX] = size
+            self._evict()
+
+    def _evict(self):
+        # mounts sharing the directory write entries this process never sees
+        if time.monotonic() - self._scanned >= self.RESCAN:
+            self._scan()
+
+        total = sum(self._sizes.values())
+        if total <= self.maxsize:
+            return
+
+        def mtime(name):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                return 0
+
+        for name in sorted(self._sizes, key=mtime):
+            if total <= self.maxsize:
+                break
+
+            total -= self._sizes.pop(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class BlobStore(DiskCache):
+    SUFFIX = ".blob"
+
+    def open(self, url):
+        path = self._path(self.key(url))
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted right after the open, the file object still reads it
+            pass
+
+        return f
+
+    def put(self, url, data):
+        self._write(self.key(url), [data])
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if (entry := self._data.get(key)) is None:
+                return default
+            elif time.monotonic() - entry[0] >= self.ttl:
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[1] if entry is not None else default
@@ -0,0 +1,35 @@
+import json
+import os
+import socket
+import sys
+import threading
+
+
+def socketpath():
+    rundir = os.environ.get("XDG_RUNTIME_DIR", "/tmp")
+    return os.path.join(rundir, f"anyfsd-{os.getuid()}.sock")
+
+
+def connect(path, handler, argv):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(json.dumps(dict(handler=handler, args=argv)).encode() + b"\n")
+    reader = sock.makefile("rb")
+    status = reader.readline().decode().strip()
+    if status != "ok":
+        print(status.removeprefix("error "), file=sys.stderr)
+        sys.exit(1)
+
+    def forward():
+        for line in sys.stdin.buffer:
+            sock.sendall(line)
+
+        sock.shutdown(socket.SHUT_WR)
+
+    threading.Thread(target=forward, daemon=True).start()
+    try:
+        while data := reader.read1(1 << 16):
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+    except KeyboardInterrupt:
+        pass
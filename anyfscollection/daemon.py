@@ -0,0 +1,98 @@
+import argparse
+import importlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+
+from . import engine, protocol, session, trace, warmup
+# the client side lives apart so anyfsc.py starts without requests
+from .client import socketpath
+
+
+HANDLERS = ["kodik", "mangalib", "pm3u8", "reactor", "rutube"]
+
+
+def _shared():
+    # options configured once for the whole daemon process
+    parser = argparse.ArgumentParser()
+    session.add_arguments(parser)
+    trace.add_arguments(parser)
+    return vars(parser.parse_args([]))
+
+
+def create(handler, argv):
+    handler = os.path.basename(handler).removesuffix(".py")
+    if handler not in HANDLERS:
+        raise ValueError(f"Unknown handler {handler}")
+
+    module = importlib.import_module(handler)
+    try:
+        args = module.argparser().parse_args(argv)
+    except SystemExit:
+        raise ValueError(f"Invalid arguments for {handler}: {' '.join(argv)}")
+
+    shared = [k for k, v in _shared().items() if getattr(args, k) != v]
+    if shared:
+        options = ", ".join("--" + x.replace("_", "-") for x in shared)
+        raise ValueError(f"{options} apply to the whole daemon, pass them to anyfsd.py instead")
+
+    return warmup.create(module.create(args), args), args.pipeline
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not (line := self.rfile.readline()):
+            # a liveness probe from another anyfsd
+            return
+
+        request = json.loads(line)
+        try:
+            fetcher, pipeline = create(request["handler"], request["args"])
+        except Exception as ex:
+            self.wfile.write(f"error {ex}\n".encode())
+            return
+
+        self.wfile.write(b"ok\n")
+        lines = io.TextIOWrapper(self.rfile, encoding="utf-8")
+        try:
+            engine.serve(fetcher, lines, protocol.Writer(self.wfile), pipeline)
+        finally:
+            # stop pollers and executors of the mount once its connection is gone
+            if hasattr(fetcher, "close"):
+                fetcher.close()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _running(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+
+    return True
+
+
+def serve(path):
+    if os.path.exists(path):
+        # only a stale socket is replaced, a live daemon keeps its mounts
+        if _running(path):
+            print(f"anyfsd is already listening on {path}", file=sys.stderr)
+            sys.exit(1)
+
+        os.remove(path)
+
+    with Server(path, Handler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import sys
+import threading
+
+from . import protocol
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("engine")
+    group.add_argument("--pipeline", help="Paths to read ahead and fetch concurrently, answers keep request order",
+                       type=int, default=1)
+
+
+class Slot:
+    # a stream for one pipelined path, chunks are handed to the event loop in write order
+    MAXSIZE = 8 << 20
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.size = 0
+        self.closed = False
+        self.drained = threading.Condition()
+
+    def write(self, data):
+        # a path behind a slow head waits here instead of holding its whole answer in memory
+        with self.drained:
+            self.drained.wait_for(lambda: self.size < self.MAXSIZE or self.closed)
+            if self.closed:
+                return len(data)
+
+            self.size += len(data)
+
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def taken(self, size):
+        with self.drained:
+            self.size -= size
+            self.drained.notify()
+
+    def close(self):
+        with self.drained:
+            self.closed = True
+            self.drained.notify()
+
+
+async def _pipeline(fetcher, lines, stream, limit):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    incoming = asyncio.Queue()
+    slots = asyncio.Queue()
+    pending = asyncio.Semaphore(limit)
+    # made outside read(), a with block there would wait for running fetches on the loop thread
+    executor = ThreadPoolExecutor(limit)
+    live = set()
+
+    def feed():
+        # a daemon thread, so a blocked stdin read never holds up exit
+        with contextlib.suppress(RuntimeError):
+            for line in lines:
+                loop.call_soon_threadsafe(incoming.put_nowait, line)
+
+            loop.call_soon_threadsafe(incoming.put_nowait, None)
+
+    threading.Thread(target=feed, daemon=True).start()
+
+    async def read():
+        while (line := await incoming.get()) is not None:
+            await pending.acquire()
+            slot = Slot(loop, asyncio.Queue())
+            live.add(slot)
+            out = protocol.Writer(slot)
+            future = loop.run_in_executor(executor, protocol.handle, fetcher, protocol.normpath(line), out)
+            future.add_done_callback(lambda _, queue=slot.queue: queue.put_nowait(None))
+            await slots.put((future, slot))
+
+        await slots.put(None)
+
+    async def write():
+        while (item := await slots.get()) is not None:
+            future, slot = item
+            while (chunk := await slot.queue.get()) is not None:
+                stream.write(chunk)
+                stream.flush()
+                slot.taken(len(chunk))
+
+            await future
+            live.discard(slot)
+            pending.release()
+
+    reader = asyncio.create_task(read())
+    try:
+        await write()
+    finally:
+        reader.cancel()
+        for slot in live:
+            slot.close()
+
+        executor.shutdown(wait=False)
+
+
+def serve(fetcher, lines=None, out=None, limit=1):
+    if limit <= 1:
+        return protocol.serve(fetcher, lines, out)
+
+    import asyncio
+
+    lines = lines if lines is not None else sys.stdin
+    out = out if out is not None else protocol.Writer()
+    try:
+        asyncio.run(_pipeline(fetcher, lines, out.stream, limit))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,64 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import multiprocessing
+
+
+FORMATS = dict(jpeg="jpg", png="png", webp="webp")
+
+
+def transcode(data, width=None, fmt=None, quality=85):
+    from PIL import Image
+
+    image = Image.open(BytesIO(data))
+    fmt = fmt or image.format.lower()
+    if width is not None and image.width > width:
+        image = image.resize((width, image.height * width // image.width), Image.Resampling.LANCZOS)
+
+    if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    # the encoders copy the source profile over unless it is gone from info
+    image.info.pop("icc_profile", None)
+    options = dict(jpeg=dict(quality=quality, optimize=True, progressive=True),
+                   png=dict(optimize=True),
+                   webp=dict(quality=quality, method=4))
+    buf = BytesIO()
+    image.save(buf, format=fmt.upper(), **options.get(fmt, {}))
+    return buf.getvalue()
+
+
+class Transcoder:
+    def __init__(self, width=None, fmt=None, quality=85, workers=None):
+        self.width = width
+        self.fmt = fmt
+        self.quality = quality
+        # workers start lazily from handler threads, forking there can inherit held locks
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver"))
+        self.tag = f"w={width},f={fmt},q={quality}"
+
+    def submit(self, data):
+        return self.executor.submit(transcode, data, self.width, self.fmt, self.quality)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def rename(self, name):
+        if self.fmt is None:
+            return name
+
+        return name.rsplit(".", 1)[0] + "." + FORMATS[self.fmt]
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("images")
+    group.add_argument("--width", help="Downscale images wider than this", type=int)
+    group.add_argument("--format", help="Convert images to this format", choices=list(FORMATS))
+    group.add_argument("--quality", help="Quality of lossy formats", type=int, default=85)
+    group.add_argument("--transcode-workers", help="Processes to transcode images in", type=int)
+
+
+def create(args):
+    if args.width is None and args.format is None:
+        return None
+
+    return Transcoder(args.width, args.format, args.quality, args.transcode_workers)
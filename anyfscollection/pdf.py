@@ -0,0 +1,75 @@
+from io import BytesIO
+import zlib
+
+from PIL import Image
+
+
+class PdfWriter:
+    COLORSPACES = dict(RGB="/DeviceRGB", L="/DeviceGray", CMYK="/DeviceCMYK")
+
+    def __init__(self, fileobj, resolution=100.0):
+        self.f = fileobj
+        self.resolution = resolution
+        self.offsets = {}
+        self.pages = []
+        self.f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.nextid = 3
+
+    def _object(self, objid, body, stream=None):
+        self.offsets[objid] = self.f.tell()
+        self.f.write(f"{objid} 0 obj\n".encode())
+        self.f.write(body.encode())
+        if stream is not None:
+            self.f.write(b"\nstream\n")
+            self.f.write(stream)
+            self.f.write(b"\nendstream")
+
+        self.f.write(b"\nendobj\n")
+
+    def _allocate(self, count):
+        ids = range(self.nextid, self.nextid + count)
+        self.nextid += count
+        return ids
+
+    @classmethod
+    def _encode(cls, data):
+        image = Image.open(BytesIO(data))
+        if image.format == "JPEG" and image.mode in cls.COLORSPACES:
+            decode = " /Decode [1 0 1 0 1 0 1 0]" if image.mode == "CMYK" else ""
+            return image.size, image.mode, f"/Filter /DCTDecode{decode}", data
+
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        return image.size, image.mode, "/Filter /FlateDecode", zlib.compress(image.tobytes())
+
+    def add(self, data):
+        (width, height), mode, filters, stream = self._encode(data)
+        imageid, contentid, pageid = self._allocate(3)
+        self._object(imageid, (
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height}"
+            f" /ColorSpace {self.COLORSPACES[mode]} /BitsPerComponent 8 {filters} /Length {len(stream)} >>"
+        ), stream)
+        del stream
+
+        pagewidth = width * 72.0 / self.resolution
+        pageheight = height * 72.0 / self.resolution
+        content = f"q {pagewidth:.2f} 0 0 {pageheight:.2f} 0 0 cm /Im0 Do Q".encode()
+        self._object(contentid, f"<< /Length {len(content)} >>", content)
+        self._object(pageid, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pagewidth:.2f} {pageheight:.2f}]"
+            f" /Resources << /XObject << /Im0 {imageid} 0 R >> >> /Contents {contentid} 0 R >>"
+        ))
+        self.pages.append(pageid)
+
+    def close(self):
+        self._object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+        kids = " ".join(f"{x} 0 R" for x in self.pages)
+        self._object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>")
+
+        xref = self.f.tell()
+        self.f.write(f"xref\n0 {self.nextid}\n0000000000 65535 f \n".encode())
+        for objid in range(1, self.nextid):
+            self.f.write(f"{self.offsets[objid]:010d} 00000 n \n".encode())
+
+        self.f.write(f"trailer\n<< /Size {self.nextid} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
@@ -0,0 +1,21 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+
+
+def imap(fn, items, workers, window=None):
+    window = max(window if window is not None else 2 * workers, 1)
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            for item in items:
+                # keep the caller's context so spans land in its trace
+                pending.append(executor.submit(contextvars.copy_context().run, fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
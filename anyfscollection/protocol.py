@@ -0,0 +1,160 @@
+import io
+import json
+import os
+import shutil
+import sys
+
+from . import trace
+from .cache import TTLCache
+
+
+class Writer:
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout.buffer
+        self.buf = bytearray()
+
+    def _header(self, kind, path, **attrs):
+        parts = [kind]
+        for key, val in attrs.items():
+            if val is None or val is False:
+                continue
+            elif val is True:
+                val = "true"
+
+            parts.append(f"{key}={val}")
+
+        parts.append(f"path={path}\n")
+        self.buf += " ".join(parts).encode()
+
+    def bytes(self, path, data, time=None, hide=False):
+        if isinstance(data, str):
+            data = data.encode()
+
+        self._header("bytes", path, time=time, hide=hide, size=len(data))
+        self.buf += data
+
+    def json(self, path, data, time=None, hide=False):
+        self.bytes(path, json.dumps(data, ensure_ascii=False, indent=2), time=time, hide=hide)
+
+    def url(self, path, url, headers=(), time=None, hide=False):
+        self._header("url", path, time=time, hide=hide, headers=len(headers))
+        self.buf += "".join(x + "\n" for x in [url, *headers]).encode()
+
+    def entity(self, path, time=None, hide=False):
+        self._header("entity", path, time=time, hide=hide)
+
+    def link(self, path, realpath, time=None, hide=False):
+        self._header("link", path, time=time, hide=hide)
+        self.buf += (realpath + "\n").encode()
+
+    def raw(self, data):
+        self.buf += data
+
+    def notfound(self, path):
+        self._header("notfound", path)
+
+    def ioerror(self, path):
+        self._header("ioerror", path)
+
+    def copy(self, path, size, fileobj, time=None):
+        self._header("bytes", path, time=time, size=size)
+        self.flush()
+        with trace.span("write"):
+            shutil.copyfileobj(fileobj, self.stream)
+
+    def sendfile(self, path, fileobj, time=None):
+        try:
+            size = os.fstat(fileobj.fileno()).st_size
+        except (AttributeError, io.UnsupportedOperation):
+            self.bytes(path, fileobj.read(), time=time)
+            self.flush()
+            return
+
+        self._header("bytes", path, time=time, size=size)
+        self.flush()
+        with trace.span("write"):
+            try:
+                outfd = self.stream.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                shutil.copyfileobj(fileobj, self.stream)
+                return
+
+            offset = 0
+            while offset < size:
+                offset += os.sendfile(outfd, fileobj.fileno(), offset, size - offset)
+
+    def eom(self):
+        self.buf += b"eom\n"
+        self.flush()
+
+    def discard(self):
+        self.buf.clear()
+
+    def flush(self):
+        with trace.span("write"):
+            if self.buf:
+                self.stream.write(self.buf)
+                self.buf.clear()
+
+            self.stream.flush()
+
+
+class Deferred:
+    def __init__(self, enabled=False, maxsize=16384):
+        self.enabled = enabled
+        self.store = TTLCache(maxsize, float("inf"))
+
+    def defer(self, out, path, render, time=None):
+        self.store.put(path, render)
+        out.entity(path, time=time)
+
+    def json(self, out, path, data, time=None):
+        if self.enabled:
+            self.defer(out, path, lambda x: x.json(path, data, time=time), time=time)
+        else:
+            out.json(path, data, time=time)
+
+    def fetch(self, out, path):
+        if (render := self.store.get(path)) is None:
+            return False
+
+        render(out)
+        return True
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("protocol")
+    group.add_argument("--lazy-meta", help="Announce metadata json files and render them on open", action="store_true")
+
+
+def normpath(path):
+    path = path.strip()
+    if len(path) > 2:
+        path = path.rstrip("/")
+
+    return path
+
+
+def handle(fetcher, path, out):
+    with trace.request(path):
+        try:
+            fetcher.fetch(path, out)
+        except BrokenPipeError:
+            raise
+        except OSError as ex:
+            # upstream failures, including suspended hosts, must not kill the handler
+            print(f"{path}: {ex}", file=sys.stderr)
+            out.discard()
+            out.ioerror(path)
+
+        out.eom()
+
+
+def serve(fetcher, lines=None, out=None):
+    lines = lines if lines is not None else sys.stdin
+    out = out if out is not None else Writer()
+    try:
+        for path in lines:
+            handle(fetcher, normpath(path), out)
+    except KeyboardInterrupt:
+        pass
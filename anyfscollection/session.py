@@ -0,0 +1,239 @@
+from io import BytesIO
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from . import throttle, trace
+from .cache import BlobStore, DiskCache
+
+
+POOLSIZE = 10
+TIMEOUT = (5.0, 30.0)
+CACHESIZE = 256
+BLOBSIZE = 2048
+RETRIES = 3
+RATE = 5.0
+BURST = 10
+BREAKER = (5, 30.0)
+MAXRETRYAFTER = 60.0
+RETRYSTATUS = (429, 500, 502, 503, 504)
+# only api hosts are rate limited, image and video cdns are not
+THROTTLED = ("api.cdnlibs.org", "rutube.ru", "kodik.info", "api.joyreactor.cc")
+UPSTREAM = None
+
+_sessions = {}
+_hosts = {}
+_lock = threading.Lock()
+_cache = None
+blobs = None
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("http")
+    group.add_argument("--pool-size", help="Keep-alive connections per host", type=int, default=POOLSIZE)
+    group.add_argument("--connect-timeout", help="Connect timeout in seconds", type=float, default=TIMEOUT[0])
+    group.add_argument("--read-timeout", help="Read timeout in seconds", type=float, default=TIMEOUT[1])
+    group.add_argument("--cache-dir", help="Keep api responses in this directory between runs")
+    group.add_argument("--cache-size", help="Size limit of the cache directory in MiB", type=int, default=CACHESIZE)
+    group.add_argument("--blob-dir", help="Keep downloaded images in this directory between runs")
+    group.add_argument("--blob-size", help="Size limit of the image directory in MiB", type=int, default=BLOBSIZE)
+    group.add_argument("--retries", help="Retries of failed or throttled requests", type=int, default=RETRIES)
+    group.add_argument("--rate", help="Requests per second to each api host", type=float, default=RATE)
+    group.add_argument("--burst", help="Requests to each api host allowed at once", type=int, default=BURST)
+    group.add_argument("--breaker-threshold", help="Failures in a row that stop requests to a host", type=int, default=BREAKER[0])
+    group.add_argument("--breaker-cooldown", help="Seconds to fail fast before probing a failing host", type=float, default=BREAKER[1])
+    group.add_argument("--upstream", help="Send all requests to this server, prefixing paths with the original host")
+
+
+def configure(args):
+    global POOLSIZE, TIMEOUT, RETRIES, RATE, BURST, BREAKER, UPSTREAM, _cache, blobs
+    POOLSIZE = args.pool_size
+    TIMEOUT = (args.connect_timeout, args.read_timeout)
+    RETRIES = args.retries
+    RATE = args.rate
+    BURST = args.burst
+    BREAKER = (args.breaker_threshold, args.breaker_cooldown)
+    UPSTREAM = args.upstream.rstrip("/") if args.upstream is not None else None
+    _cache = DiskCache(args.cache_dir, args.cache_size << 20) if args.cache_dir is not None else None
+    blobs = BlobStore(args.blob_dir, args.blob_size << 20) if args.blob_dir is not None else None
+    with _lock:
+        for s in _sessions.values():
+            s.close()
+
+        _sessions.clear()
+        _hosts.clear()
+
+
+def session(url):
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _lock:
+        if (s := _sessions.get(key)) is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOLSIZE)
+            s.mount(f"{parts.scheme}://{parts.netloc}", adapter)
+            _sessions[key] = s
+
+        return s
+
+
+class CircuitOpen(requests.ConnectionError):
+    pass
+
+
+class Host:
+    def __init__(self, name):
+        self.name = name
+        self.bucket = throttle.TokenBucket(RATE if name in THROTTLED else None, BURST)
+        self.breaker = throttle.Breaker(*BREAKER)
+
+
+def host(url):
+    name = urlsplit(url).hostname
+    with _lock:
+        if (h := _hosts.get(name)) is None:
+            h = _hosts[name] = Host(name)
+
+        return h
+
+
+def _target(url):
+    if UPSTREAM is None:
+        return url
+
+    parts = urlsplit(url)
+    return f"{UPSTREAM}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+
+def request(method, url, **kwargs):
+    with trace.span("http"):
+        return _request(method, url, **kwargs)
+
+
+def _request(method, url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    h = host(url)
+    target = _target(url)
+    for attempt in range(RETRIES + 1):
+        if not h.breaker.allow():
+            raise CircuitOpen(f"{h.name} is failing, requests are suspended")
+
+        h.bucket.acquire()
+        try:
+            response = session(target).request(method, target, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            h.breaker.failure()
+            if attempt == RETRIES:
+                raise
+
+            time.sleep(throttle.backoff(attempt))
+            continue
+        except requests.RequestException:
+            # settle a half-open probe, otherwise the host stays suspended
+            h.breaker.failure()
+            raise
+
+        if target != url:
+            # handlers resolve relative links against the url they asked for
+            response.url = url
+
+        if response.status_code not in RETRYSTATUS:
+            h.breaker.success()
+            return response
+
+        h.breaker.failure()
+        delay = throttle.retryafter(response.headers.get("retry-after"))
+        if delay is not None and delay > MAXRETRYAFTER:
+            h.breaker.trip(delay)
+            return response
+        elif attempt == RETRIES:
+            return response
+
+        response.close()
+        if delay is not None:
+            h.bucket.pause(delay)
+        else:
+            time.sleep(throttle.backoff(attempt))
+
+    return response
+
+
+def _response(url, meta, body):
+    response = requests.Response()
+    response.url = url
+    response.status_code = 200
+    response.headers = CaseInsensitiveDict(meta["headers"])
+    response.encoding = meta["encoding"]
+    response._content = body
+    return response
+
+
+def _cachedget(url, ttl, **kwargs):
+    key = _cache.key(url, kwargs.get("headers"))
+    entry = _cache.load(key)
+    if entry is not None:
+        meta, body = entry
+        if time.time() - meta["time"] < ttl:
+            return _response(url, meta, body)
+
+        headers = dict(kwargs.get("headers") or {})
+        if "etag" in meta["headers"]:
+            headers["If-None-Match"] = meta["headers"]["etag"]
+
+        if "last-modified" in meta["headers"]:
+            headers["If-Modified-Since"] = meta["headers"]["last-modified"]
+
+        kwargs["headers"] = headers
+
+    try:
+        response = request("GET", url, **kwargs)
+    except requests.RequestException:
+        if entry is None:
+            raise
+
+        return _response(url, meta, body)
+
+    if response.status_code == 304 and entry is not None:
+        meta["time"] = time.time()
+        _cache.store(key, meta, body)
+        return _response(url, meta, body)
+    elif response.status_code == 200:
+        headers = {k.lower(): v for k, v in response.headers.items() if k.lower() in ("etag", "last-modified", "content-type")}
+        meta = {"time": time.time(), "headers": headers, "encoding": response.encoding}
+        _cache.store(key, meta, response.content)
+    elif response.status_code >= 500 and entry is not None:
+        return _response(url, meta, body)
+
+    return response
+
+
+def get(url, ttl=None, **kwargs):
+    if _cache is not None and ttl is not None and not kwargs.get("stream"):
+        return _cachedget(url, ttl, **kwargs)
+
+    return request("GET", url, **kwargs)
+
+
+def getblob(url, **kwargs):
+    if (f := blobs.open(url)) is None:
+        response = get(url, **kwargs)
+        response.raise_for_status()
+        blobs.put(url, response.content)
+        if (f := blobs.open(url)) is None:
+            # evicted right away, by --blob-size or another process
+            f = BytesIO(response.content)
+
+    return f
+
+
+def serveblob(out, path, url, time=None, **kwargs):
+    with getblob(url, **kwargs) as f:
+        out.sendfile(path, f, time=time)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -0,0 +1,91 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self.until = max(self.until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+
+                self.stamp = now
+                if now < self.until:
+                    wait = self.until - now
+                elif not self.rate or self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class Breaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.until = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.until is None:
+                return True
+            elif self.trial or time.monotonic() < self.until:
+                return False
+
+            # half-open: let a single request probe the host
+            self.trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.until = None
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold:
+                self.until = time.monotonic() + self.cooldown
+
+    def trip(self, seconds):
+        with self._lock:
+            self.trial = False
+            self.until = time.monotonic() + seconds
+
+
+def backoff(attempt, base=0.5, cap=30.0):
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def retryafter(value):
+    if value is None:
+        return None
+    elif value.strip().isdigit():
+        return float(value)
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,192 @@
+import contextlib
+import contextvars
+import json
+import math
+import sys
+import threading
+import time
+from collections import Counter
+
+
+INTERVAL = 60.0
+SAMPLEPERIOD = 0.01
+BUCKETS = [2**i for i in range(17)]
+
+hooks = []
+
+_sink = None
+_slow = None
+_lock = threading.Lock()
+_local = threading.local()
+_current = contextvars.ContextVar("request", default=None)
+_active = set()
+_histograms = {}
+_last = 0.0
+_null = contextlib.nullcontext()
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("tracing")
+    group.add_argument("--trace", help="Write per path spans as json lines to this file, - for stderr")
+    group.add_argument("--trace-interval", help="Seconds between aggregate histograms", type=float, default=INTERVAL)
+    group.add_argument("--trace-slow", help="Sample stacks of paths taking longer than this many ms", type=float)
+
+
+def configure(args):
+    global INTERVAL, _sink, _slow, _last
+    INTERVAL = args.trace_interval
+    if args.trace is None:
+        _sink = None
+    elif args.trace == "-":
+        _sink = sys.stderr
+    else:
+        _sink = open(args.trace, "a", buffering=1)
+
+    _last = time.monotonic()
+    if args.trace_slow is not None and _slow is None:
+        threading.Thread(target=_sample, daemon=True).start()
+
+    _slow = args.trace_slow / 1000 if args.trace_slow is not None else None
+
+
+class Span:
+    def __init__(self, phase):
+        self.phase = phase
+        self.nested = 0.0
+
+    def __enter__(self):
+        self.request = _current.get()
+        self.stack = _local.__dict__.setdefault("stack", [])
+        self.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].nested += elapsed
+
+        if self.request is not None:
+            self.request.add(self.phase, elapsed - self.nested)
+
+
+class Request:
+    def __init__(self, path):
+        self.path = path
+        self.phases = {}
+        self.samples = Counter()
+        self.thread = threading.get_ident()
+        self._lock = threading.Lock()
+
+    def add(self, phase, elapsed):
+        with self._lock:
+            n, total = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (n + 1, total + elapsed)
+
+    def __enter__(self):
+        self.token = _current.set(self)
+        self.start = time.perf_counter()
+        with _lock:
+            _active.add(self)
+
+        return self
+
+    def __exit__(self, exctype, *exc):
+        elapsed = time.perf_counter() - self.start
+        _current.reset(self.token)
+        with _lock:
+            _active.discard(self)
+
+        record = dict(ts=time.time(), path=self.path, ms=elapsed * 1000)
+        with self._lock:
+            record["phases"] = {k: dict(n=n, ms=v * 1000) for k, (n, v) in self.phases.items()}
+
+        if exctype is not None:
+            record["error"] = exctype.__name__
+
+        if self.samples:
+            record["profile"] = dict(self.samples.most_common(50))
+            for hook in hooks:
+                hook(record)
+
+        _emit(record)
+        _aggregate(record)
+
+
+def span(phase):
+    if _sink is None:
+        return _null
+
+    return Span(phase)
+
+
+def request(path):
+    if _sink is None:
+        return _null
+
+    return Request(path)
+
+
+def _emit(record):
+    with _lock:
+        _sink.write(json.dumps(record, ensure_ascii=False) + "\n")
+        _sink.flush()
+
+
+def _bucket(ms):
+    if ms <= 1:
+        return "<=1ms"
+    elif ms > BUCKETS[-1]:
+        return f">{BUCKETS[-1]}ms"
+
+    return f"<={2**math.ceil(math.log2(ms))}ms"
+
+
+def _aggregate(record):
+    global _last
+    with _lock:
+        _histograms.setdefault("request", Counter())[_bucket(record["ms"])] += 1
+        for phase, val in record["phases"].items():
+            _histograms.setdefault(phase, Counter())[_bucket(val["ms"])] += 1
+
+        now = time.monotonic()
+        if now - _last < INTERVAL:
+            return
+
+        histograms = {k: dict(sorted(v.items(), key=lambda x: _order(x[0]))) for k, v in _histograms.items()}
+        _histograms.clear()
+        _last = now
+
+    _emit(dict(ts=time.time(), histograms=histograms))
+
+
+def _order(bucket):
+    return float(bucket.strip("<=>ms")) + (0.5 if bucket.startswith(">") else 0)
+
+
+def _sample():
+    # a stack sampler for paths running longer than --trace-slow
+    while True:
+        time.sleep(SAMPLEPERIOD)
+        if _slow is None:
+            continue
+
+        now = time.perf_counter()
+        with _lock:
+            slow = [x for x in _active if now - x.start > _slow]
+
+        if not slow:
+            continue
+
+        frames = sys._current_frames()
+        for req in slow:
+            if (frame := frames.get(req.thread)) is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_code.co_name}")
+                frame = frame.f_back
+
+            req.samples[";".join(reversed(stack))] += 1
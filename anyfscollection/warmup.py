@@ -0,0 +1,136 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import io
+import sys
+import threading
+import time
+
+from . import protocol
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("warmup")
+    group.add_argument("--warmup-depth", help="Levels of likely subdirectories to render ahead in background, 0 disables",
+                       type=int, default=0)
+    group.add_argument("--warmup-workers", help="Subdirectories to render ahead at once", type=int, default=2)
+    group.add_argument("--warmup-memory", help="Memory for rendered subdirectories in MiB", type=int, default=32)
+    group.add_argument("--warmup-ttl", help="Seconds to keep a rendered subdirectory", type=float, default=300)
+
+
+def create(fetcher, args):
+    if args.warmup_depth <= 0 or not hasattr(fetcher, "warmup"):
+        return fetcher
+
+    return Warmer(fetcher, args.warmup_depth, args.warmup_workers, args.warmup_memory << 20, args.warmup_ttl)
+
+
+class TooLarge(Exception):
+    pass
+
+
+class Capped(io.BytesIO):
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def write(self, data):
+        if self.tell() + len(data) > self.maxsize:
+            raise TooLarge()
+
+        return super().write(data)
+
+
+class Rendered:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, path, data):
+        if len(data) > self.maxsize:
+            return
+
+        with self._lock:
+            if (entry := self._data.pop(path, None)) is not None:
+                self.size -= len(entry[1])
+
+            self._data[path] = (time.monotonic(), data)
+            self.size += len(data)
+            while self.size > self.maxsize:
+                _, (_, old) = self._data.popitem(last=False)
+                self.size -= len(old)
+
+    def __contains__(self, path):
+        with self._lock:
+            entry = self._data.get(path)
+            return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def pop(self, path):
+        with self._lock:
+            if (entry := self._data.pop(path, None)) is None:
+                return None
+
+            self.size -= len(entry[1])
+            return entry[1] if time.monotonic() - entry[0] < self.ttl else None
+
+
+class Warmer:
+    def __init__(self, fetcher, depth=1, workers=2, maxsize=32 << 20, ttl=300):
+        self.fetcher = fetcher
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(workers)
+        self.rendered = Rendered(maxsize, ttl)
+        self.inflight = {}
+        self.toolarge = set()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def fetch(self, path, out):
+        with self.lock:
+            future = self.inflight.get(path)
+
+        if future is not None:
+            future.result()
+
+        if (data := self.rendered.pop(path)) is not None:
+            out.raw(data)
+        else:
+            self.fetcher.fetch(path, out)
+
+        self._schedule(path, self.depth)
+
+    def close(self):
+        self.closed = True
+        self.executor.shutdown(cancel_futures=True)
+        if hasattr(self.fetcher, "close"):
+            self.fetcher.close()
+
+    def _schedule(self, path, depth):
+        if depth <= 0 or self.closed:
+            return
+
+        for child in self.fetcher.warmup(path):
+            with self.lock:
+                if child in self.inflight or child in self.rendered or child in self.toolarge:
+                    continue
+
+                self.inflight[child] = self.executor.submit(self._render, child, depth)
+
+    def _render(self, path, depth):
+        try:
+            # stop as soon as the render outgrows the whole budget
+            out = protocol.Writer(Capped(self.rendered.maxsize))
+            self.fetcher.fetch(path, out)
+            out.flush()
+            self.rendered.put(path, out.stream.getvalue())
+            self._schedule(path, depth - 1)
+        except TooLarge:
+            with self.lock:
+                self.toolarge.add(path)
+        except Exception as ex:
+            print(f"warmup {path}: {ex}", file=sys.stderr)
+        finally:
+            with self.lock:
+                self.inflight.pop(path, None)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+import argparse
+
+from anyfscollection import daemon, session, trace
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve all anyfs handlers from one process")
+    parser.add_argument("-s", "--socket", help="Unix socket to listen on", default=daemon.socketpath())
+    session.add_arguments(parser)
+    trace.add_arguments(parser)
+    args = parser.parse_args()
+
+    session.configure(args)
+    trace.configure(args)
+    daemon.serve(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anyfscollection import imaging
+
+
+def synthetic(count, width=1400, height=2000):
+    from PIL import Image, ImageDraw
+
+    pages = []
+    for i in range(count):
+        image = Image.effect_noise((width, height), 40 + i).convert("RGB")
+        draw = ImageDraw.Draw(image)
+        for y in range(0, height, 120):
+            draw.rectangle((60, y + 20, width - 60, y + 90), outline=(0, 0, 0), width=4)
+
+        buf = BytesIO()
+        image.save(buf, format="PNG" if i % 2 else "JPEG", quality=92)
+        pages.append(buf.getvalue())
+
+    return pages
+
+
+def measure(fn, pages):
+    start = time.perf_counter()
+    size = sum(len(x) for x in fn(pages))
+    return len(pages) / (time.perf_counter() - start), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure page transcoding throughput")
+    parser.add_argument("fixtures", help="Page images to transcode, synthetic pages if omitted", nargs="*")
+    parser.add_argument("-n", "--number", help="Synthetic pages to generate", type=int, default=16)
+    parser.add_argument("--width", help="Downscale pages wider than this", type=int, default=1000)
+    parser.add_argument("--format", help="Target format", choices=list(imaging.FORMATS), default="webp")
+    parser.add_argument("--quality", help="Quality of lossy formats", type=int, default=85)
+    parser.add_argument("-w", "--workers", help="Transcoding processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.fixtures:
+        pages = []
+        for fixture in args.fixtures:
+            with open(fixture, "rb") as f:
+                pages.append(f.read())
+    else:
+        pages = synthetic(args.number)
+
+    source = sum(len(x) for x in pages)
+    print(f"pages={len(pages)} source={source / 2**20:.1f}MiB target={args.format} width={args.width}")
+
+    rate, size = measure(lambda x: [imaging.transcode(p, args.width, args.format, args.quality) for p in x], pages)
+    print(f"serial pages/s={rate:.2f} output={size / 2**20:.1f}MiB")
+
+    transcoder = imaging.Transcoder(args.width, args.format, args.quality, args.workers)
+    transcoder.submit(pages[0]).result()
+    rate, size = measure(lambda x: [f.result() for f in [transcoder.submit(p) for p in x]], pages)
+    print(f"processes={args.workers} pages/s={rate:.2f} output={size / 2**20:.1f}MiB")
+    transcoder.executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kodik import Fetcher
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def soup(text, boxclass):
+    from bs4 import BeautifulSoup as Soup
+
+    tree = Soup(text, features="lxml")
+    return [x.attrs for x in tree.find("div", {"class": boxclass}).find("select").find_all("option")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare kodik player page extraction")
+    parser.add_argument("fixtures", help="Saved player pages", nargs="*",
+                        default=[os.path.join(FIXTURES, "kodik-serial.html")])
+    parser.add_argument("-n", "--number", help="Runs per measurement", type=int, default=20)
+    args = parser.parse_args()
+
+    for fixture in args.fixtures:
+        with open(fixture, encoding="utf-8") as f:
+            text = f.read()
+
+        for box in ["serial-translations-box", "serial-series-box"]:
+            count = len(Fetcher._options(text, box))
+            best = min(timeit.repeat(lambda: Fetcher._options(text, box), number=args.number, repeat=3))
+            line = f"{os.path.basename(fixture)} {box} options={count} extract={best / args.number * 1000:.3f}ms"
+            try:
+                base = min(timeit.repeat(lambda: soup(text, box), number=args.number, repeat=3))
+                line += f" soup={base / args.number * 1000:.3f}ms speedup={base / best:.1f}x"
+            except ImportError:
+                pass
+
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FIXTURES = os.path.join(ROOT, "bench", "fixtures")
+TRACES = os.path.join(ROOT, "bench", "traces")
+SCENARIOS = {
+    "kodik": ["kodik.py", "https://kodik.info/serial/50000/eb8ac8ce8a245e6b33138131c541013d/720p"],
+    "kodik-search": ["kodik.py"],
+    "mangalib": ["mangalib.py", "https://mangalib.me/ru/manga/2048--manga"],
+    # transcoding processes start while the pipeline threads run
+    "mangalib-transcode": ["mangalib.py", "https://mangalib.me/ru/manga/2048--manga", "--width", "200", "--pipeline", "2"],
+    "pm3u8": ["pm3u8.py", "https://hls.local/master.m3u8"],
+    "reactor": ["reactor.py", "общее"],
+    "rutube": ["rutube.py", "164395"],
+}
+RUTUBEPAGES = 5
+REACTORPOSTS = 500
+KODIKTOKEN = "447d179e875efe44217f20d1ee2146be"
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+def rutubepage(name, page):
+    data = json.loads(fixture(name))
+    data["page"] = page
+    data["has_next"] = page < RUTUBEPAGES
+    if page > 1:
+        for x in data["results"]:
+            x["id"] = hashlib.md5(f"{page}-{x['id']}".encode()).hexdigest() if isinstance(x["id"], str) else x["id"] + page * 1000
+
+    return data
+
+
+def graphql(query):
+    posts = json.loads(fixture("reactor-posts.json"))
+    pager = {"count": REACTORPOSTS, "id": "UG9zdFBhZ2VyOjE="}
+    for alias in re.findall(r"(page\d+): posts", query):
+        pager[alias] = posts
+
+    return {"data": {"tag": {"postPager": pager}}}
+
+
+def route(method, host, path, query, body):
+    page = int(query.get("page", ["1"])[0])
+    if host == "rutube.ru":
+        if re.match(r"/api/profile/user/\d+/$", path):
+            return json.loads(fixture("rutube-profile.json"))
+        elif re.match(r"/api/(video/person/\d+|playlist/custom/\d+/videos)/$", path):
+            return rutubepage("rutube-videos.json", page)
+        elif re.match(r"/api/playlist/user/\d+/$", path):
+            return rutubepage("rutube-playlists.json", page)
+        elif re.match(r"/api/play/options/\w+/$", path):
+            return json.loads(fixture("rutube-options.json"))
+    elif host == "kodik.info":
+        if path == "/ftor":
+            return json.loads(fixture("kodik-ftor.json"))
+
+        return "text/html; charset=utf-8", fixture("kodik-serial.html")
+    elif host == "kodik-add.com":
+        return "application/javascript", f'var a={{domain:"kodik.info",token="{KODIKTOKEN}"}};'.encode()
+    elif host == "kodikapi.com" and path == "/search":
+        if query.get("token") != [KODIKTOKEN]:
+            return 500, {"error": "Отсутствует или неверный токен"}
+
+        return json.loads(fixture("kodik-search.json"))
+    elif host == "api.cdnlibs.org":
+        if path.endswith("/chapters"):
+            return json.loads(fixture("mangalib-chapters.json"))
+        elif path.endswith("/chapter"):
+            return json.loads(fixture("mangalib-chapter.json"))
+
+        return json.loads(fixture("mangalib-info.json"))
+    elif host == "img33.imgslib.link":
+        return "image/jpeg", fixture("mangalib-page.jpg")
+    elif host == "api.joyreactor.cc" and method == "POST":
+        return graphql(json.loads(body)["query"])
+    elif host == "hls.local" and path in ["/master.m3u8", "/vod.m3u8"]:
+        return "application/vnd.apple.mpegurl", fixture(path[1:])
+
+    return None
+
+
+class Upstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _serve(self, method):
+        body = self.rfile.read(int(self.headers.get("content-length") or 0))
+        host, _, path = self.path[1:].partition("/")
+        parts = urlsplit("/" + path)
+        latency, jitter = self.server.latency
+        time.sleep(max(0.0, random.gauss(latency, jitter)))
+
+        result = route(method, host, parts.path, parse_qs(parts.query), body)
+        if result is None:
+            ctype, data, code = "text/plain", b"not found", 404
+        elif isinstance(result, tuple) and isinstance(result[0], int):
+            code, ctype, data = result[0], "application/json", json.dumps(result[1], ensure_ascii=False).encode()
+        elif isinstance(result, tuple):
+            (ctype, data), code = result, 200
+        else:
+            ctype, data, code = "application/json", json.dumps(result, ensure_ascii=False).encode(), 200
+
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._serve("GET")
+
+    def do_POST(self):
+        self._serve("POST")
+
+
+def readresponse(stream):
+    records = 0
+    size = 0
+    while line := stream.readline():
+        size += len(line)
+        if line == b"eom\n":
+            return records, size
+
+        records += 1
+        head = line.partition(b" path=")[0].split(b" ")
+        attrs = dict(x.split(b"=", 1) for x in head[1:])
+        if head[0] == b"bytes":
+            size += len(stream.read(int(attrs[b"size"])))
+        elif head[0] == b"url":
+            size += sum(len(stream.readline()) for _ in range(int(attrs.get(b"headers", 0)) + 1))
+        elif head[0] == b"link":
+            size += len(stream.readline())
+
+    raise EOFError("handler exited before eom")
+
+
+def peakrss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) << 10
+    except OSError:
+        pass
+
+    return None
+
+
+def run(argv, paths, burst=False, think=0.0):
+    proc = subprocess.Popen([sys.executable, *argv], cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    timings = []
+    records = size = 0
+    try:
+        if burst:
+            # the first path lists the directory, the rest are looked up at once like a file manager does
+            start = time.perf_counter()
+            proc.stdin.write(paths[0].encode() + b"\n")
+            proc.stdin.flush()
+            records, size = readresponse(proc.stdout)
+            timings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            proc.stdin.write(b"".join(x.encode() + b"\n" for x in paths[1:]))
+            proc.stdin.flush()
+
+        for path in paths[len(timings):]:
+            if not burst:
+                time.sleep(think)
+                start = time.perf_counter()
+                proc.stdin.write(path.encode() + b"\n")
+                proc.stdin.flush()
+
+            n, s = readresponse(proc.stdout)
+            timings.append(time.perf_counter() - start)
+            records += n
+            size += s
+
+        rss = peakrss(proc.pid)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+    if rss is None:
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss << 10
+
+    wall = timings[0] + timings[-1] if burst else sum(timings)
+    return timings, wall, records, size, rss
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay path traces against handlers and a local upstream stand-in")
+    parser.add_argument("handlers", help="Handlers to measure", nargs="*", default=list(SCENARIOS))
+    parser.add_argument("-n", "--rounds", help="Fresh handler runs per trace", type=int, default=5)
+    parser.add_argument("-l", "--latency", help="Artificial upstream latency in ms", type=float, default=0.0)
+    parser.add_argument("-j", "--jitter", help="Standard deviation of the upstream latency in ms", type=float, default=0.0)
+    parser.add_argument("-t", "--trace", help="Trace file for a single handler instead of bench/traces")
+    parser.add_argument("-a", "--args", help="Extra handler arguments", default="--rate 0")
+    parser.add_argument("-b", "--burst", help="Send all paths after the first at once, latency counts from the burst",
+                        action="store_true")
+    parser.add_argument("--think", help="Pause in ms before each path after the first, like a user reading a listing",
+                        type=float, default=0.0)
+    parser.add_argument("--json", help="Print the report as json", action="store_true")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    server.daemon_threads = True
+    server.latency = (args.latency / 1000, args.jitter / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    upstream = f"http://127.0.0.1:{server.server_port}"
+
+    report = {}
+    for handler in args.handlers:
+        with open(args.trace or os.path.join(TRACES, handler + ".txt"), encoding="utf-8") as f:
+            paths = [x.rstrip("\n") for x in f if x.strip()]
+
+        argv = SCENARIOS[handler] + ["--upstream", upstream] + args.args.split()
+        latencies = {x: [] for x in paths}
+        total = records = size = rss = 0
+        for _ in range(args.rounds):
+            timings, wall, n, s, r = run(argv, paths, args.burst, args.think / 1000)
+            for path, elapsed in zip(paths, timings):
+                latencies[path].append(elapsed * 1000)
+
+            total += wall
+            records += n
+            size += s
+            rss = max(rss, r)
+
+        report[handler] = {
+            "records/s": records / total,
+            "bytes/s": size / total,
+            "peak-rss": rss,
+            "paths": {x: {f"p{p}": percentile(v, p) for p in [50, 90, 99]} | {"max": max(v)} for x, v in latencies.items()},
+        }
+
+    server.shutdown()
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return
+
+    for handler, result in report.items():
+        print(f"{handler} records/s={result['records/s']:.0f} MiB/s={result['bytes/s'] / 2**20:.2f} peak-rss={result['peak-rss'] / 2**20:.1f}MiB")
+        for path, values in result["paths"].items():
+            print(f"  {path} " + " ".join(f"{k}={v:.1f}ms" for k, v in values.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import offline
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BUDGET = os.path.join(ROOT, "bench", "startup-budget.json")
+HANDLERS = ["kodik", "mangalib", "pm3u8", "reactor", "rutube"]
+
+
+def importtime(module):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=ROOT, capture_output=True, text=True, check=True)
+    total = 0
+    modules = []
+    for line in proc.stderr.splitlines():
+        if m := re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line):
+            if m[4] == module:
+                total = int(m[2])
+            elif len(m[3]) == 3:
+                modules.append((int(m[2]), m[4]))
+
+    return total / 1000, sorted(modules, reverse=True)[:3]
+
+
+def firsteom(argv):
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, *argv], cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdin.write(b"/\n")
+    proc.stdin.flush()
+    offline.readresponse(proc.stdout)
+    elapsed = time.perf_counter() - start
+    proc.stdin.close()
+    proc.wait()
+    return elapsed * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure handler cold start")
+    parser.add_argument("handlers", help="Handlers to measure", nargs="*", default=HANDLERS)
+    parser.add_argument("-n", "--runs", help="Runs per measurement, the best is kept", type=int, default=5)
+    parser.add_argument("-t", "--tolerance", help="Allowed slowdown over the budget", type=float, default=0.5)
+    parser.add_argument("-u", "--update", help="Write measured values as the new budget", action="store_true")
+    args = parser.parse_args()
+
+    budget = {}
+    if os.path.exists(BUDGET):
+        with open(BUDGET) as f:
+            budget = json.load(f)
+
+    # first-eom on / runs against the fixture stand-in of bench/offline.py
+    server = ThreadingHTTPServer(("127.0.0.1", 0), offline.Upstream)
+    server.daemon_threads = True
+    server.latency = (0.0, 0.0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    upstream = ["--upstream", f"http://127.0.0.1:{server.server_port}", "--rate", "0"]
+
+    failed = False
+    for handler in args.handlers:
+        results = [importtime(handler) for _ in range(args.runs)]
+        imports, heaviest = min(results)
+        measured = {"import": imports}
+        measured["first-eom"] = min(firsteom(offline.SCENARIOS[handler] + upstream) for _ in range(args.runs))
+
+        for metric, value in measured.items():
+            limit = budget.get(handler, {}).get(metric)
+            status = ""
+            if limit is not None:
+                status = f" budget={limit:.1f}ms"
+                if value > limit * (1 + args.tolerance):
+                    status += " REGRESSION"
+                    failed = True
+
+            print(f"{handler} {metric}={value:.1f}ms{status}")
+
+        print(" ", ", ".join(f"{name}={us / 1000:.1f}ms" for us, name in heaviest))
+        if args.update:
+            budget[handler] = {k: round(v, 1) for k, v in measured.items()}
+
+    server.shutdown()
+    if args.update:
+        with open(BUDGET, "w") as f:
+            json.dump(budget, f, indent=2)
+            f.write("\n")
+
+    sys.exit(1 if failed and not args.update else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,130 +2,283 @@
 
 import argparse
 import base64
-import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import html
 import re
-import sys
+import threading
+import time
+from urllib.parse import quote
 
-from bs4 import BeautifulSoup as Soup
-import requests
+from anyfscollection import engine, protocol, session, trace, warmup
+from anyfscollection.cache import TTLCache
 
 
 class Fetcher:
     BASEURL = "https://kodik.info"
+    TOKENURL = "https://kodik-add.com/add-players.min.js?v=2"
+    SEARCHURL = "https://kodikapi.com/search?title={}&token={}"
+    TTL = dict(root=3600, series=3600, token=86400)
 
-    def __init__(self, url):
+    def __init__(self, url=None, prefetch=3, workers=2, linkttl=600, lazymeta=False, searchttl=3600):
+        self.meta = protocol.Deferred(lazymeta)
         self.url = url
         self._TEMPLATE = self.BASEURL + "/{}/{}/{}/720p"
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(workers)
+        self.links = TTLCache(256, linkttl)
+        self.lock = threading.Lock()
+        self.upcoming = {}
+        self.rot = None
+        self.first = None
+        self.roottitle = ""
+        self.titles = {}
+        self.token = None
+        self.tokenexpiry = 0.0
+        self.tokenlock = threading.Lock()
+        self.searches = TTLCache(256, searchttl)
 
-    @staticmethod
-    def _printbytes(path, buf):
-        print("bytes size=", len(buf.encode()), " path=", path, sep="")
-        sys.stdout.write(buf)
-
-    @staticmethod
-    def _printentity(path, hide=False):
-        print("entity hide=", hide, " path=", path, sep="")
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
-    @staticmethod
-    def _printjson(path, data):
-        Fetcher._printbytes(path, json.dumps(data, ensure_ascii=False, indent=2))
-
-    @staticmethod
-    def _printlink(path, realpath, hide=False):
-        print("link hide=", hide, " path=", path, sep="")
-        print(realpath)
+    def warmup(self, path):
+        return [self.first] if path == "/" and self.first is not None else []
 
-    def fetch(self, path):
-        if path == "/":
-            self._printroot()
+    def fetch(self, path, out):
+        if self.meta.fetch(out, path):
+            pass
+        elif path == "/" and self.url is None:
+            out.entity("/search")
+            out.entity("/hashes", hide=True)
+        elif path == "/":
+            self._printroot(out)
+        elif path == "/search":
+            pass
+        elif m := re.match(r"/search/([^/]+)$", path):
+            self._printsearch(out, path, m[1])
         elif (m := re.match(r"/hashes/([^/]+)/(\d+)/(\w+)/?([^/]+)?", path)):
             if m[1] == "serial" or m[1] == "season":
-                self._extractseries(m[0], m[1], m[2], m[3])
+                self._extractseries(out, m[0], m[1], m[2], m[3])
             else:
-                self._extractvideo(m[0], m[1], m[2], m[3], m[4])
+                self._extractvideo(out, m[0], m[1], m[2], m[3], m[4])
         else:
-            print("notfound path=", path, sep="")
+            out.notfound(path)
+
+    @staticmethod
+    def _title(text):
+        m = re.search(r"<title[^>]*>(.*?)</title>", text, re.S)
+        return html.unescape(m[1]).strip() if m is not None else ""
+
+    @staticmethod
+    def _options(text, boxclass):
+        m = re.search(rf'<div[^>]*class="[^"]*\b{boxclass}\b[^"]*"[^>]*>.*?</select>', text, re.S)
+        if m is None:
+            return []
+
+        attrs = re.compile(r'''([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+        return [{k.lower(): html.unescape(a or b or c) for k, a, b, c in attrs.findall(x)}
+                for x in re.findall(r"<option\b([^>]*)>", m[0])]
 
-        print("eom")
+    def _printroot(self, out):
+        response = session.get(self.url, ttl=self.TTL["root"])
+        response.raise_for_status()
+        text = response.text
+        with trace.span("parse"):
+            title = self._title(text)
+            options = self._options(text, "serial-translations-box")
 
-    def _printroot(self):
-        soup = Soup(requests.get(self.url).text, features="lxml")
-        title = soup.find("title").text
         title = title.replace("/", "-")
         self.roottitle = title
 
-        self._printentity("/hashes", hide=True)
-        container = soup.find("div", {"class": "serial-translations-box"}).find("select")
-        for x in container.find_all("option"):
-            datahash = x.get_attribute_list("data-media-hash")[0]
-            dataid = x.get_attribute_list("data-media-id")[0]
-            datatype = x.get_attribute_list("data-media-type")[0]
-            dataname = x.get_attribute_list("data-title")[0]
+        out.entity("/search")
+        out.entity("/hashes", hide=True)
+        for x in options:
+            datahash = x.get("data-media-hash")
+            dataid = x.get("data-media-id")
+            datatype = x.get("data-media-type")
+            dataname = x.get("data-title")
             realpath = f"/hashes/{datatype}/{dataid}/{datahash}"
-            self._printlink("/" + dataname, realpath)
+            out.link("/" + dataname, realpath)
+            self.first = self.first or realpath
+
+    def _searchtoken(self, refresh=False):
+        # a token fetch must not hold up link resolving under self.lock
+        with self.tokenlock:
+            if refresh or self.token is None or time.monotonic() >= self.tokenexpiry:
+                # a forced refresh revalidates the disk cached script instead of trusting it
+                response = session.get(self.TOKENURL, ttl=0 if refresh else self.TTL["token"])
+                response.raise_for_status()
+                text = response.text
+                m = re.search(r'token="([^"]+)"', text)
+                self.token = m[1] if m is not None else None
+                self.tokenexpiry = time.monotonic() + self.TTL["token"]
+
+            return self.token
+
+    def _search(self, title):
+        if (data := self.searches.get(title)) is not None:
+            return data
+
+        for refresh in [False, True]:
+            if (token := self._searchtoken(refresh)) is None:
+                continue
+
+            response = session.get(self.SEARCHURL.format(quote(title), token))
+            with trace.span("parse"):
+                try:
+                    data = response.json()
+                except ValueError:
+                    data = dict(error=response.reason)
+
+            if response.ok and "error" not in data:
+                self.searches.put(title, data)
+                return data
+
+        return None
+
+    def _printsearch(self, out, path, title):
+        if (data := self._search(title)) is None:
+            out.ioerror(path)
+            return
+
+        self.meta.json(out, path + "/results.json", data)
+        results = []
+        for x in data.get("results", []):
+            if (m := re.match(r"(?:https?:)?//[^/]+/(\w+)/(\d+)/(\w+)", x.get("link", ""))) is None:
+                continue
+
+            name = f"{x['title']} ({x['year']})".replace("/", "-")
+            results.append((name, x, m))
+
+        counts = Counter(name for name, _, _ in results)
+        for name, x, m in results:
+            if counts[name] > 1:
+                name += " - " + x.get("translation", {}).get("title", m[2]).replace("/", "-")
 
-    def _extractseries(self, path, stype, dataid, datahash):
+            key = (m[1], m[2], m[3])
+            self.titles[key] = x["title"]
+            if m[1] == "serial" or m[1] == "season":
+                out.link(f"{path}/{name}", f"/hashes/{m[1]}/{m[2]}/{m[3]}")
+            else:
+                out.link(f"{path}/{name}", f"/hashes/{m[1]}/{m[2]}/{m[3]}/{x['title'].replace('/', '-')}")
+
+    def _extractseries(self, out, path, stype, dataid, datahash):
+        showtitle = self.titles.get((stype, dataid, datahash), self.roottitle)
         url = self._TEMPLATE.format(stype, dataid, datahash)
-        soup = Soup(requests.get(url).text, features="lxml")
-        seriesbox = soup.find("div", {"class": "serial-series-box"})
-        container = seriesbox.find("select")
+        response = session.get(url, ttl=self.TTL["series"])
+        response.raise_for_status()
+        text = response.text
+        with trace.span("parse"):
+            options = self._options(text, "serial-series-box")
+
         lst = ["#EXTM3U", "#EXT-X-VERSION:3"]
-        for x in container.find_all("option"):
-            dataid = x.get_attribute_list("data-id")[0]
-            datahash = x.get_attribute_list("data-hash")[0]
-            title = x.get_attribute_list("data-title")[0]
+        keys = []
+        for x in options:
+            dataid = x.get("data-id")
+            datahash = x.get("data-hash")
+            title = x.get("data-title")
             title = title.replace("/", "-")
 
-            self._printlink(f"{path}/{title}", f"/hashes/seria/{dataid}/{datahash}/{title}", hide=True)
-            lst.append("#EXTINF:," + self.roottitle + " - " + title)
+            out.link(f"{path}/{title}", f"/hashes/seria/{dataid}/{datahash}/{title}", hide=True)
+            lst.append("#EXTINF:," + showtitle + " - " + title)
             lst.append(f"./{title}/720.m3u8")
+            keys.append(("seria", dataid, datahash))
+            self.titles[keys[-1]] = showtitle
+
+        out.bytes(path + "/playlist.m3u8", "\n".join(lst) + "\n")
+        for i, key in enumerate(keys):
+            self.upcoming[key] = keys[i + 1:i + 1 + self.prefetch]
+
+        for key in keys[:self.prefetch]:
+            self._resolve(key)
 
-        self._printbytes(path + "/playlist.m3u8", "\n".join(lst) + "\n")
+    def _resolve(self, key):
+        with self.lock:
+            if (future := self.links.get(key)) is None:
+                future = self.executor.submit(contextvars.copy_context().run, self._ftor, *key)
+                self.links.put(key, future)
 
-    def _extractvideo(self, path, datatype, dataid, datahash, title):
+            return future
+
+    def _ftor(self, datatype, dataid, datahash):
         url = f"https://kodik.info/ftor?type={datatype}&id={dataid}&hash={datahash}"
-        data = requests.get(url).json()
-        self._printjson(path + "/info.json", data)
-        for resolution, val in data["links"].items():
-            text = f"#EXTM3U\n#EXT-X-VERSION:3\n#EXTINF:,{self.roottitle} - {title}\n"
-            text += self._decode(val[0]["src"])
-            self._printbytes(f"{path}/{resolution}.m3u8", text)
+        response = session.get(url)
+        response.raise_for_status()
+        with trace.span("parse"):
+            data = response.json()
 
-    @staticmethod
-    def _rotN(data):
+        with trace.span("decode"):
+            links = {resolution: self._decode(val[0]["src"]) for resolution, val in data["links"].items()}
+
+        return data, links
+
+    def _extractvideo(self, out, path, datatype, dataid, datahash, title):
+        key = (datatype, dataid, datahash)
+        future = self._resolve(key)
+        for x in self.upcoming.get(key, []):
+            self._resolve(x)
+
+        if future.exception() is not None:
+            self.links.pop(key)
+
+        data, links = future.result()
+        self.meta.json(out, path + "/info.json", data)
+        showtitle = self.titles.get(key, self.roottitle)
+        for resolution, link in links.items():
+            text = f"#EXTM3U\n#EXT-X-VERSION:3\n#EXTINF:,{showtitle} - {title}\n"
+            text += link
+            out.bytes(f"{path}/{resolution}.m3u8", text)
+
+    def _rotN(self, data):
         alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        rotated = alphabet
-        for r in range(25):
-            rotated = rotated[1:] + rotated[0]
+        offsets = list(range(1, 26))
+        if self.rot is not None:
+            offsets.remove(self.rot)
+            offsets.insert(0, self.rot)
+
+        for r in offsets:
+            rotated = alphabet[r:] + alphabet[:r]
             trans = str.maketrans(alphabet + alphabet.lower(), rotated + rotated.lower())
             transformed = data.translate(trans)
             decoded = base64.b64decode(transformed + '=' * (-len(transformed) % 4)) # fix padding
             if decoded.endswith(b".m3u8"):
+                self.rot = r
                 return decoded.decode()
 
         raise RuntimeError("Exhausted rot tries")
 
-    @staticmethod
-    def _decode(data):
+    def _decode(self, data):
         if not data.endswith(".m3u8"):
-            data = __class__._rotN(data)
+            data = self._rotN(data)
 
         return re.sub(r'^//', 'https://', data)
 
 
-def main():
+def argparser():
     parser = argparse.ArgumentParser(description="Kodik handler")
-    parser.add_argument("url", help="Url of the serial")
-    args = parser.parse_args()
-
-    fetcher = Fetcher(args.url)
-    try:
-        for path in sys.stdin:
-            path = path.strip()
-            fetcher.fetch(path)
-            sys.stdout.flush()
-    except KeyboardInterrupt:
-        pass
+    parser.add_argument("url", help="Url of the serial, only /search is served without it", nargs="?")
+    parser.add_argument("--prefetch", help="Episodes to resolve ahead of the player", type=int, default=3)
+    parser.add_argument("-w", "--workers", help="Episodes to resolve in parallel", type=int, default=2)
+    parser.add_argument("--link-ttl", help="Seconds to keep resolved episode links", type=int, default=600)
+    parser.add_argument("--search-ttl", help="Seconds to keep search results", type=int, default=3600)
+    protocol.add_arguments(parser)
+    session.add_arguments(parser)
+    trace.add_arguments(parser)
+    engine.add_arguments(parser)
+    warmup.add_arguments(parser)
+    return parser
+
+
+def create(args):
+    return Fetcher(args.url, args.prefetch, args.workers, args.link_ttl, args.lazy_meta, args.search_ttl)
+
+
+def main():
+    args = argparser().parse_args()
+    session.configure(args)
+    trace.configure(args)
+    engine.serve(warmup.create(create(args), args), limit=args.pipeline)
 
 
 if __name__ == "__main__":
@@ -1,98 +1,177 @@
 #!/usr/bin/env python
 
 import argparse
-from io import BytesIO
-import json
 import re
-import shutil
-import sys
+from tempfile import SpooledTemporaryFile
 
-from PIL import Image
-import requests
+from anyfscollection import engine, imaging, pool, protocol, session, trace, warmup
+from anyfscollection.cache import TTLCache
 
 
 class Fetcher:
-    def __init__(self, url):
+    TTL = dict(info=86400, chapters=3600, chapter=86400)
+    SPOOLSIZE = 16 << 20
+
+    def __init__(self, url, workers=4, prefetch=8, direct=False, lazymeta=False, transcoder=None):
+        self.meta = protocol.Deferred(lazymeta)
         parts = re.match(r"(?P<domain>https?://[^/]+)/(?P<lang>[^/]+)/(?P<name>[^/]+/[^/]+).*", url)
         self.name = parts.group("name")
         self.domain = parts.group("domain")
+        self.workers = workers
+        self.prefetch = prefetch
+        self.direct = direct
+        self.transcoder = transcoder
+        self.latest = None
+        self.chapters = TTLCache(64, self.TTL["chapter"])
 
     @staticmethod
-    def printbytes(path, buf):
-        if isinstance(buf, str):
-            buf = buf.encode()
+    def _getjson(url, ttl):
+        response = session.get(url, ttl=ttl)
+        response.raise_for_status()
+        with trace.span("parse"):
+            return response.json()
 
-        print("bytes size=", len(buf), " path=", path, sep="", flush=True)
-        sys.stdout.buffer.write(buf)
-        sys.stdout.flush()
+    def _chapter(self, volume, number):
+        if (data := self.chapters.get((volume, number))) is None:
+            data = self._getjson(f"https://api.cdnlibs.org/api/{self.name}/chapter?volume={volume}&number={number}", self.TTL["chapter"])
+            self.chapters.put((volume, number), data)
 
-    @staticmethod
-    def printurl(path, url, headers=[]):
-        print("url headers=", len(headers), " path=", path, sep="")
-        print(url)
-        for h in headers:
-            print(h)
+        return data
 
     @staticmethod
-    def printjson(path, data):
-        Fetcher.printbytes(path, json.dumps(data, ensure_ascii=False, indent=2))
+    def _imageurl(item):
+        return "https://img33.imgslib.link" + item["url"]
+
+    def _download(self, item):
+        if self.transcoder is not None:
+            return self._transcode(item)
+
+        if session.blobs is not None:
+            return item["image"], session.getblob(self._imageurl(item), headers={"referer": self.domain})
 
-    def fetch(self, path):
-        if path == "/":
-            data = requests.get(f"https://api.cdnlibs.org/api/{self.name}").json()
-            self.printjson("/info.json", data)
-            self.printurl("/poster.jpg", data["data"]["cover"]["default"])
+        response = session.get(self._imageurl(item), headers={"referer": self.domain})
+        response.raise_for_status()
+        return item["image"], response.content
 
-            data = requests.get(f"https://api.cdnlibs.org/api/{self.name}/chapters").json()
-            self.printjson("/chapters.json", data)
+    def _transcode(self, item):
+        url = self._imageurl(item)
+        key = url + "#" + self.transcoder.tag
+        if session.blobs is not None and (f := session.blobs.open(key)) is not None:
+            with f:
+                data = f.read()
+
+            return self.transcoder.rename(item["image"]), data
+
+        if session.blobs is not None:
+            with session.getblob(url, headers={"referer": self.domain}) as f:
+                data = f.read()
+        else:
+            response = session.get(url, headers={"referer": self.domain})
+            response.raise_for_status()
+            data = response.content
+
+        with trace.span("image"):
+            data = self.transcoder.submit(data).result()
+        if session.blobs is not None:
+            session.blobs.put(key, data)
+
+        return self.transcoder.rename(item["image"]), data
+
+    def close(self):
+        if self.transcoder is not None:
+            self.transcoder.close()
+
+    def warmup(self, path):
+        if path != "/" or self.latest is None:
+            return []
+
+        # a rendered chapter holds all of its images, only direct mode lists urls
+        return [self.latest] if self.direct else [self.latest + "/info.json"]
+
+    def fetch(self, path, out):
+        if self.meta.fetch(out, path):
+            pass
+        elif path == "/":
+            data = self._getjson(f"https://api.cdnlibs.org/api/{self.name}", self.TTL["info"])
+            self.meta.json(out, "/info.json", data)
+            poster = data["data"]["cover"]["default"]
+            if session.blobs is not None:
+                self.meta.defer(out, "/poster.jpg", lambda x: session.serveblob(x, "/poster.jpg", poster))
+            else:
+                out.url("/poster.jpg", poster)
+
+            data = self._getjson(f"https://api.cdnlibs.org/api/{self.name}/chapters", self.TTL["chapters"])
+            self.meta.json(out, "/chapters.json", data)
             text = ""
             for item in data["data"]:
                 text += "./" + item["volume"] + "-" + item["number"] + ".pdf\n"
                 text += "./" + item["volume"] + "-" + item["number"] + "\n"
 
-            self.printbytes("/chapters.txt", text)
-        elif m := re.match(r"/(\d+)-(\d+)", path):
-            data = requests.get(f"https://api.cdnlibs.org/api/{self.name}/chapter?volume={m[1]}&number={m[2]}").json()
-            self.printjson(path + "/info.json", data)
-            for item in data["data"]["pages"]:
-                url = "https://img33.imgslib.link" + item["url"]
-                with requests.get(url, stream=True, headers={"referer": self.domain}) as f:
-                    print("bytes size=", f.raw.headers["content-length"], " path=", path + "/" + item["image"], sep="", flush=True)
-                    shutil.copyfileobj(f.raw, sys.stdout.buffer)
-                    sys.stdout.flush()
-        elif m := re.match(r"/(\d+)-(\d+)\.pdf", path):
-            data = requests.get(f"https://api.cdnlibs.org/api/{self.name}/chapter?volume={m[1]}&number={m[2]}").json()
-            images = []
-            for item in data["data"]["pages"]:
-                url = "https://img33.imgslib.link" + item["url"]
-                with requests.get(url, stream=True, headers={"referer": self.domain}) as f:
-                    images.append(Image.open(f.raw))
-
-            temp = BytesIO()
-            newimages[0].save(temp, format="PDF", resolution=100.0, save_all=True, append_images=newimages[1:])
-            self.printbytes(path, temp.getvalue())
+            out.bytes("/chapters.txt", text)
+            if data["data"]:
+                self.latest = "/" + data["data"][-1]["volume"] + "-" + data["data"][-1]["number"]
+        elif m := re.match(r"/(\d+)-(\d+)$", path):
+            data = self._chapter(m[1], m[2])
+            self.meta.json(out, path + "/info.json", data)
+            if self.direct:
+                for item in data["data"]["pages"]:
+                    out.url(path + "/" + item["image"], self._imageurl(item), [f"referer:{self.domain}"])
+            else:
+                for name, content in pool.imap(self._download, data["data"]["pages"], self.workers, self.prefetch):
+                    if isinstance(content, bytes):
+                        out.bytes(path + "/" + name, content)
+                        out.flush()
+                    else:
+                        with content:
+                            out.sendfile(path + "/" + name, content)
+        elif m := re.match(r"/(\d+)-(\d+)/info\.json$", path):
+            out.json(path, self._chapter(m[1], m[2]))
+        elif m := re.match(r"/(\d+)-(\d+)\.pdf$", path):
+            from anyfscollection.pdf import PdfWriter
+
+            data = self._chapter(m[1], m[2])
+            with SpooledTemporaryFile(max_size=self.SPOOLSIZE) as f:
+                pdf = PdfWriter(f, resolution=100.0)
+                for _, content in pool.imap(self._download, data["data"]["pages"], self.workers, self.prefetch):
+                    if not isinstance(content, bytes):
+                        with content:
+                            content = content.read()
+
+                    with trace.span("image"):
+                        pdf.add(content)
+
+                pdf.close()
+                size = f.tell()
+                f.seek(0)
+                out.copy(path, size, f)
         else:
-            print("notfound path=", path, sep="")
+            out.notfound(path)
 
-        print("eom")
 
-
-def main():
+def argparser():
     parser = argparse.ArgumentParser(description="Mangalib api handler")
     parser.add_argument("url", help="Url with manga")
-    args = parser.parse_args()
-
-    fetcher = Fetcher(args.url)
-    try:
-        for path in sys.stdin:
-            path = path.strip()
-            if len(path) > 2:
-                path = path.rstrip("/")
-
-            fetcher.fetch(path)
-            sys.stdout.flush()
-    except KeyboardInterrupt:
-        pass
+    parser.add_argument("-w", "--workers", help="Pages to download in parallel", type=int, default=4)
+    parser.add_argument("--prefetch", help="Downloaded pages to keep ahead of output", type=int, default=8)
+    parser.add_argument("-d", "--direct", help="Let anyfs download chapter pages itself", action="store_true")
+    protocol.add_arguments(parser)
+    session.add_arguments(parser)
+    trace.add_arguments(parser)
+    engine.add_arguments(parser)
+    warmup.add_arguments(parser)
+    imaging.add_arguments(parser)
+    return parser
+
+
+def create(args):
+    return Fetcher(args.url, args.workers, args.prefetch, args.direct, args.lazy_meta, imaging.create(args))
+
+
+def main():
+    args = argparser().parse_args()
+    session.configure(args)
+    trace.configure(args)
+    engine.serve(warmup.create(create(args), args), limit=args.pipeline)
 
 
 if __name__ == "__main__":
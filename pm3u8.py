@@ -1,89 +1,196 @@
 #!/usr/bin/env python
 
 import argparse
+from collections import Counter
 from copy import deepcopy
-import json
-import re
+import posixpath
 import sys
+import threading
+from urllib.parse import urljoin, urlsplit
 
 import m3u8
-import requests
 
+from anyfscollection import engine, session, trace, warmup
 
-class Fetcher:
-    def __init__(self, url, name, referer):
-        self.referer = referer
-        headers = {}
-        if self.referer is not None:
-            headers = {"referer":self.referer}
 
-        self.lst = m3u8.load(url, headers=headers)
-        self.name = name if name is not None else "video"
+class HTTPClient:
+    def download(self, uri, timeout=None, headers={}, verify_ssl=True):
+        response = session.get(uri, headers=headers, verify=verify_ssl)
+        response.raise_for_status()
+        return response.text, urljoin(response.url, ".")
 
-    @staticmethod
-    def printbytes(path, buf):
-        if isinstance(buf, str):
-            buf = buf.encode()
 
-        print("bytes size=", len(buf), " path=", path, sep="", flush=True)
-        sys.stdout.buffer.write(buf)
-        sys.stdout.flush()
+def load(url, headers):
+    with trace.span("parse"):
+        return m3u8.load(url, headers=headers, http_client=HTTPClient())
 
-    @staticmethod
-    def printurl(path, url, headers=[], hide=False):
-        print("url headers=", len(headers), sep="", end="")
-        if hide:
-            print(" hide=true", end="")
 
-        print(" path=", path, sep="")
-        print(url)
-        for h in headers:
-            print(h)
+class Playlist:
+    def __init__(self, url, headers, refresh=True, lst=None):
+        self.url = url
+        self.headers = headers
+        self.seqnames = {}
+        self.stopped = threading.Event()
+        lst = lst if lst is not None else self._load()
+        self.state = self._build(lst)
+        if refresh and self._islive(lst):
+            threading.Thread(target=self._poll, args=(lst,), daemon=True).start()
+
+    def _load(self):
+        return load(self.url, self.headers)
 
     @staticmethod
-    def printjson(path, data):
-        Fetcher.printbytes(path, json.dumps(data, ensure_ascii=False, indent=2))
+    def _islive(lst):
+        return not lst.is_endlist and (lst.playlist_type or "").lower() != "vod"
+
+    def _names(self, lst):
+        seq = lst.media_sequence or 0
+        basenames = [posixpath.basename(urlsplit(s.uri).path) for s in lst.segments]
+        counts = Counter(x for i, x in enumerate(basenames) if seq + i not in self.seqnames)
+        used = set(self.seqnames.values())
+        names = {}
+        for i, x in enumerate(basenames):
+            if (name := self.seqnames.get(seq + i)) is None:
+                name = x if counts[x] == 1 and x not in used else f"{seq + i}-{x}"
+                used.add(name)
+
+            names[seq + i] = name
+
+        self.seqnames = names
+        return list(names.values())
+
+    def _build(self, lst):
+        names = self._names(lst)
+        index = dict(zip(names, lst.segments))
+        normalized = deepcopy(lst)
+        for s, name in zip(normalized.segments, names):
+            s.uri = name
+
+        return index, normalized.dumps().encode()
+
+    def _poll(self, lst):
+        while self._islive(lst):
+            last = (lst.media_sequence or 0) + len(lst.segments)
+            if self.stopped.wait(lst.target_duration or 1):
+                return
+
+            try:
+                lst = self._load()
+            except (OSError, ValueError) as ex:
+                print("Playlist refresh failed:", ex, file=sys.stderr)
+                continue
+
+            if (lst.media_sequence or 0) + len(lst.segments) != last or lst.is_endlist:
+                self.state = self._build(lst)
+
+    def close(self):
+        self.stopped.set()
 
-    def fetch(self, path):
-        if path == "/":
-            normalized = deepcopy(self.lst)
-            for s in normalized.segments:
-                s.uri = s.get_path_from_uri()
 
-            self.printbytes("/" + self.name + ".m3u8", normalized.dumps())
+class Fetcher:
+    def __init__(self, url, name, referer, refresh=True):
+        self.referer = referer
+        self.headers = {}
+        if self.referer is not None:
+            self.headers = {"referer":self.referer}
+
+        self.name = name if name is not None else "video"
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        lst = load(url, self.headers)
+        if lst.is_variant:
+            self.variants = self._variants(lst)
+            self.best = max(self.variants, key=lambda x: self.variants[x].stream_info.bandwidth or 0)
+            self.playlists = {}
         else:
-            for seg in self.lst.segments:
-                if seg.get_path_from_uri() == path[1:]:
-                    headers = []
-                    if self.referer is not None:
-                        headers.append(f"Referer:{self.referer}")
-
-                    self.printurl(path, seg.absolute_uri, headers=headers)
-                    break
+            self.variants = None
+            self.playlists = {"": Playlist(url, self.headers, refresh, lst)}
+
+    @staticmethod
+    def _variants(lst):
+        def name(x):
+            if x.stream_info.resolution is not None:
+                return f"{x.stream_info.resolution[1]}p"
             else:
-                print("notfound path=", path, sep="")
+                return f"{(x.stream_info.bandwidth or 0) // 1000}k"
+
+        counts = Counter(map(name, lst.playlists))
+        variants = {}
+        for x in lst.playlists:
+            key = name(x)
+            if counts[key] > 1:
+                key += f"-{(x.stream_info.bandwidth or 0) // 1000}k"
+
+            variants.setdefault(key, x)
+
+        return variants
+
+    def _playlist(self, variant):
+        with self.lock:
+            if (playlist := self.playlists.get(variant)) is None:
+                playlist = Playlist(self.variants[variant].absolute_uri, self.headers, self.refresh)
+                self.playlists[variant] = playlist
+
+            return playlist
+
+    def close(self):
+        with self.lock:
+            for playlist in self.playlists.values():
+                playlist.close()
+
+    def warmup(self, path):
+        return ["/" + self.best] if path == "/" and self.variants is not None else []
+
+    def fetch(self, path, out):
+        if self.variants is None:
+            self._fetchmedia(out, "", path, self.playlists[""])
+        elif path == "/":
+            for x in self.variants:
+                out.entity("/" + x)
+
+            out.link("/best", "/" + self.best)
+        elif (variant := path[1:].split("/")[0]) in self.variants:
+            prefix = "/" + variant
+            self._fetchmedia(out, prefix, path[len(prefix):] or "/", self._playlist(variant))
+        else:
+            out.notfound(path)
 
-        print("eom")
+    def _fetchmedia(self, out, prefix, path, playlist):
+        index, root = playlist.state
+        if path == "/":
+            out.bytes(prefix + "/" + self.name + ".m3u8", root)
+        elif (seg := index.get(path[1:])) is not None:
+            headers = []
+            if self.referer is not None:
+                headers.append(f"Referer:{self.referer}")
 
+            out.url(prefix + path, seg.absolute_uri, headers=headers)
+        else:
+            out.notfound(prefix + path)
 
-def main():
+
+def argparser():
     parser = argparse.ArgumentParser(description="M3U8 api handler")
     parser.add_argument("url", help="Url of m3u8 list")
     parser.add_argument("-n", "--name", help="Name the list to show in player")
     parser.add_argument("-r", "--referer", help="Provide referer header")
-    args = parser.parse_args()
-
-    fetcher = Fetcher(args.url, args.name, args.referer)
-    try:
-        for path in sys.stdin:
-            path = path.strip()
-            if len(path) > 2:
-                path = path.rstrip("/")
-
-            fetcher.fetch(path)
-            sys.stdout.flush()
-    except KeyboardInterrupt:
-        pass
+    parser.add_argument("--no-refresh", help="Do not poll live playlists for new segments", action="store_true")
+    session.add_arguments(parser)
+    trace.add_arguments(parser)
+    engine.add_arguments(parser)
+    warmup.add_arguments(parser)
+    return parser
+
+
+def create(args):
+    return Fetcher(args.url, args.name, args.referer, not args.no_refresh)
+
+
+def main():
+    args = argparser().parse_args()
+    session.configure(args)
+    trace.configure(args)
+    engine.serve(warmup.create(create(args), args), limit=args.pipeline)
 
 
 if __name__ == "__main__":
@@ -3,27 +3,37 @@
 import argparse
 import base64
 from functools import reduce
-import json
 import os
+import re
 from string import Template
 import sys
 
-from graphqlclient import GraphQLClient
+from anyfscollection import engine, protocol, session, trace, warmup
+from anyfscollection.cache import TTLCache
 
 
 class Fetcher:
-    def __init__(self, tagname):
-        self.client = GraphQLClient("https://api.joyreactor.cc/graphql")
+    def __init__(self, tagname, lookahead=3, cachesize=64, ttl=600, lazymeta=False):
+        self.meta = protocol.Deferred(lazymeta)
+        self.api = "https://api.joyreactor.cc/graphql"
         self.startPage = None
         self._URL = "https://img10.joyreactor.cc/pics/post/{}"
         self.tag = tagname
+        self.lookahead = max(lookahead, 1)
+        self.pages = TTLCache(cachesize, ttl)
         self.template = Template('''
         {
             tag(name: "${tag}") {
                 postPager(type: ALL) {
                     count
                     id
-                    posts ${params} {
+                    ${posts}
+                }
+            }
+        }
+        ''')
+        self.posts = Template('''
+                    ${alias}: posts ${params} {
                         id
                         tags {
                             name
@@ -40,44 +50,18 @@ class Fetcher:
                                 value
                             }
                         }
-                    }
-                }
-            }
-        }
-        ''')
+                    }''')
         self.extmap = dict(jpeg="", png="", webm="webm/", mp4="mp4/", gif="")
 
-    @staticmethod
-    def _printbytes(path, buf):
-        print("bytes size=", len(buf.encode()), " path=", path, sep="")
-        sys.stdout.write(buf)
-
-    @staticmethod
-    def _printentity(path):
-        print("entity path=", path, sep="")
-
-    @staticmethod
-    def _printurl(path, url, headers=[]):
-        print("url headers=", len(headers), " path=", path, sep="")
-        print(url)
-        for h in headers:
-            print(h)
-
-    @staticmethod
-    def _printjson(path, data):
-        Fetcher._printbytes(path, json.dumps(data, ensure_ascii=False, indent=2))
-
     @staticmethod
     def _decodeId(x):
         return base64.b64decode(x).decode().split(":")[-1]
 
-    def _parseResult(self, path, result, pagenum):
+    def _parseResult(self, out, path, posts, pagenum):
         def multireplace(s):
             return reduce(lambda acc, x: acc.replace(x, "-"), " /#", s)
 
-        lst = []
-        postPager = result['data']['tag']['postPager']
-        for post in postPager['posts']:
+        for post in posts:
             postId = self._decodeId(post['id'])
             postPath = os.path.join(path, postId)
 
@@ -89,55 +73,104 @@ class Fetcher:
                     ext = attr['image']['type'].lower()
                     name = f"{prefix}-{imageId}.{ext}"
                     url = self._URL.format(self.extmap[ext] + name)
-                    headers = ["referer:https://joyreactor.cc/"] if ext in ["webm", "mp4"] else []
-                    self._printurl(f"{postPath}/{name}", url, headers)
+                    if session.blobs is not None and ext in ["jpeg", "png", "gif"]:
+                        self._deferblob(out, f"{postPath}/{name}", url)
+                    else:
+                        headers = ["referer:https://joyreactor.cc/"] if ext in ["webm", "mp4"] else []
+                        out.url(f"{postPath}/{name}", url, headers)
                 elif attr['type'] == "COUB":
                     url = "https://coub.com/view/" + attr["value"]
                     name = f"{prefix}-{imageId}.coub.m3u8"
-                    self._printbytes(f"{postPath}/{name}", url)
+                    out.bytes(f"{postPath}/{name}", url)
                 elif attr['type'] == "YOUTUBE":
                     url = "https://youtu.be/" + attr["value"]
                     name = f"{prefix}-{imageId}.youtube.m3u8"
-                    self._printbytes(f"{postPath}/{name}", url)
+                    out.bytes(f"{postPath}/{name}", url)
                 else:
-                    print("ioerror", f"path={postPath}/{imageId}.{postId}.err")
+                    out.ioerror(f"{postPath}/{imageId}.{postId}.err")
                     print("FAIL", postId, attr, file=sys.stderr)
 
-            self._printjson(postPath + "/info.json", post)
-
-        if self.startPage is None:
-            self.startPage = (int(postPager['count']) + 9) // 10
+            self.meta.json(out, postPath + "/info.json", post)
 
         if self.startPage - pagenum > 1:
-            self._printentity(os.path.join(path, "next"))
+            out.entity(os.path.join(path, "next"))
+
+    def _deferblob(self, out, path, url):
+        self.meta.defer(out, path, lambda x: session.serveblob(x, path, url))
+
+    def warmup(self, path):
+        if not re.fullmatch(r"/|(/next)+", path) or self.startPage is None:
+            return []
+
+        pagenum = path.count("/next") + 1
+        return [os.path.join(path, "next")] if pagenum < self.startPage else []
+
+    def fetch(self, path, out):
+        if self.meta.fetch(out, path):
+            return
 
-    def fetch(self, path):
         pagenum = path.count("/next")
         if (pagenum > 0 and self.startPage is None) or (self.startPage is not None and pagenum >= self.startPage):
-            print("notfound path=", path, sep="")
+            out.notfound(path)
+            return
 
-        params = "" if pagenum == 0 else f"(page: {self.startPage - pagenum})"
-        result = self.client.execute(self.template.substitute(tag=self.tag, params=params))
-        self._parseResult(path, json.loads(result), pagenum)
-        print("eom")
+        if (posts := self.pages.get((self.tag, pagenum))) is None:
+            # the lookahead pages may evict this one from a small cache
+            posts = self._query(pagenum)[pagenum]
 
+        self._parseResult(out, path, posts, pagenum)
 
-def main():
+    def _query(self, pagenum):
+        pagenums = [pagenum]
+        if self.startPage is not None:
+            last = min(pagenum + self.lookahead, self.startPage)
+            pagenums += [x for x in range(pagenum + 1, last) if self.pages.get((self.tag, x)) is None]
+
+        posts = []
+        for x in pagenums:
+            params = "" if x == 0 else f"(page: {self.startPage - x})"
+            posts.append(self.posts.substitute(alias=f"page{x}", params=params))
+
+        query = self.template.substitute(tag=self.tag, posts="".join(posts))
+        response = session.post(self.api, json={"query": query, "variables": {}})
+        response.raise_for_status()
+        with trace.span("parse"):
+            result = response.json()
+
+        postPager = result['data']['tag']['postPager']
+        if self.startPage is None:
+            self.startPage = (int(postPager['count']) + 9) // 10
+
+        pages = {x: postPager[f"page{x}"] for x in pagenums}
+        for x, posts in pages.items():
+            self.pages.put((self.tag, x), posts)
+
+        return pages
+
+
+def argparser():
     parser = argparse.ArgumentParser(description="Reactor api handler")
     parser.add_argument("tag", help="Tag to extract posts media", nargs="?", default="общее")
-    args = parser.parse_args()
-
-    fetcher = Fetcher(args.tag)
-    try:
-        for path in sys.stdin:
-            path = path.strip()
-            if len(path) > 2:
-                path = path.rstrip("/")
-
-            fetcher.fetch(path)
-            sys.stdout.flush()
-    except KeyboardInterrupt:
-        pass
+    parser.add_argument("-l", "--lookahead", help="Pages to request in one query", type=int, default=3)
+    parser.add_argument("--page-cache", help="Number of pages to keep in memory", type=int, default=64)
+    parser.add_argument("--page-ttl", help="Seconds to keep a page in memory", type=int, default=600)
+    protocol.add_arguments(parser)
+    session.add_arguments(parser)
+    trace.add_arguments(parser)
+    engine.add_arguments(parser)
+    warmup.add_arguments(parser)
+    return parser
+
+
+def create(args):
+    return Fetcher(args.tag, args.lookahead, args.page_cache, args.page_ttl, args.lazy_meta)
+
+
+def main():
+    args = argparser().parse_args()
+    session.configure(args)
+    trace.configure(args)
+    engine.serve(warmup.create(create(args), args), limit=args.pipeline)
 
 
 if __name__ == "__main__":
@@ -2,18 +2,75 @@
 
 import argparse
 import datetime
+import itertools
 import json
 import os
 import re
 import sys
-from urllib.request import urlopen
-from urllib.error import HTTPError
+import threading
+
+from requests import HTTPError
+
+from anyfscollection import engine, pool, protocol, session, trace, warmup
+
+
+class Index:
+    def __init__(self, filename):
+        import sqlite3
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS items (section TEXT, id TEXT, ts INTEGER, data TEXT, PRIMARY KEY (section, id))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS items_ts ON items (section, ts DESC)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sections (section TEXT PRIMARY KEY)")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def contains(self, section, itemid):
+        with self.lock:
+            cursor = self.db.execute("SELECT 1 FROM items WHERE section = ? AND id = ?", (section, itemid))
+            return cursor.fetchone() is not None
+
+    def add(self, section, items):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)",
+                                [(section, itemid, ts, json.dumps(data, ensure_ascii=False)) for itemid, ts, data in items])
+
+    def complete(self, section):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM sections WHERE section = ?", (section,)).fetchone() is not None
+
+    def markcomplete(self, section):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO sections VALUES (?)", (section,))
+
+    def items(self, section):
+        with self.lock:
+            cursor = self.db.execute("SELECT data FROM items WHERE section = ? ORDER BY ts DESC", (section,))
+            return [json.loads(x) for x, in cursor]
+
+    def get(self, itemid):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM items WHERE id = ?", (itemid,)).fetchone()
+            return json.loads(row[0]) if row is not None else None
 
 
 class Fetcher:
     BASEURL = "https://rutube.ru"
-
-    def __init__(self, userid):
+    TTL = dict(profile=86400, page=3600, options=600)
+
+    def __init__(self, userid, flat=False, workers=4, indexdir=None, lazymeta=False):
+        self.meta = protocol.Deferred(lazymeta)
+        self.flat = flat
+        self.workers = workers
+        self.index = None
+        self.synced = set()
+        if indexdir is not None:
+            os.makedirs(indexdir, exist_ok=True)
+            self.index = Index(os.path.join(indexdir, f"{userid}.sqlite"))
         self._VIDEOURL = f"{self.BASEURL}/api/video/person/{userid}/?origin__type=rtb,rst,ifrm,rspa&page={{}}"
         self._PLAYLISTURL = f"{self.BASEURL}/api/playlist/user/{userid}/?page={{}}"
         self._SHORTSURL = f"{self.BASEURL}/api/video/person/{userid}/?origin__type=rshorts&page={{}}"
@@ -25,139 +82,206 @@ class Fetcher:
     def _datetots(datets):
         return int(datetime.datetime.fromisoformat(datets).timestamp())
 
-    @staticmethod
-    def _printbytes(path, buf, ts=None):
-        args = ["bytes"]
-        if ts is not None:
-            args.append(f"time={ts}")
-
-        args.append(f"size={len(buf.encode())}")
-        args.append(f"path={path}")
-        print(*args)
-        sys.stdout.write(buf)
-
-    @staticmethod
-    def _printentity(path, ts=None, ishidden=False):
-        args = ["entity"]
-        if ts is not None:
-            args.append(f"time={ts}")
-
-        if ishidden:
-            args.append("hide=true")
-
-        args.append(f"path={path}")
-        print(*args)
+    @classmethod
+    def _itemts(cls, val):
+        if "publication_ts" in val:
+            return cls._datetots(val["publication_ts"])
+        else:
+            return cls._datetots(val["created_ts"])
 
-    @staticmethod
-    def _printurl(path, url, ts):
-        print("url time=", ts, " path=", path, sep="")
-        print(url)
+    def _sections(self):
+        return dict(videos=self._VIDEOURL, shorts=self._SHORTSURL, playlists=self._PLAYLISTURL)
 
-    @staticmethod
-    def _printjson(path, data, ts=None):
-        Fetcher._printbytes(path, json.dumps(data, ensure_ascii=False, indent=2), ts)
+    def close(self):
+        if self.index is not None:
+            self.index.close()
 
-    @staticmethod
-    def _printlink(path, realpath, ts):
-        print("link time=", ts, " path=", path, sep="")
-        print(realpath)
+    def warmup(self, path):
+        return ["/videos", "/playlists"] if path == "/" else []
 
-    def fetch(self, path):
+    def fetch(self, path, out):
         try:
-            if path == "/":
-                self._printroot()
+            if self.meta.fetch(out, path):
+                pass
+            elif path == "/":
+                self._printroot(out)
             elif m := re.match(r"/hashes/(\w{32})/(video\.m3u8|\.info\.json)", path):
-                self._printoptions(os.path.dirname(path), m[1])
+                self._printoptions(out, os.path.dirname(path), m[1])
             elif m := re.match(r"/hashes/(\d+)/videos", path):
-                self._printplaylist(path, m[1])
+                self._printplaylist(out, path, m[1])
+            elif self.index is not None and path in ["/videos", "/shorts", "/playlists"]:
+                self._printindexed(out, path[1:], path)
+            elif self.index is not None and (m := re.match(r"/hashes/(\w+)$", path)):
+                self._printhash(out, path, m[1])
+            elif self.flat and path in ["/videos", "/shorts", "/playlists"]:
+                self._printflat(out, self._sections()[path[1:]], path)
             elif re.match(r"/[^/]+(/next)*$", path):
                 pagenum = path.count("/next") + 1
                 if path.startswith("/videos"):
-                    self._printcommon(self._VIDEOURL.format(pagenum), path)
+                    self._printcommon(out, self._VIDEOURL.format(pagenum), path)
                 elif path.startswith("/shorts"):
-                    self._printcommon(self._SHORTSURL.format(pagenum), path)
+                    self._printcommon(out, self._SHORTSURL.format(pagenum), path)
                 elif path.startswith("/playlists"):
-                    self._printcommon(self._PLAYLISTURL.format(pagenum), path)
+                    self._printcommon(out, self._PLAYLISTURL.format(pagenum), path)
             else:
-                print("notfound path=", path, sep="")
+                out.notfound(path)
         except HTTPError as ex:
-            if ex.code == 404:
-                print("notfound path=", path, sep="")
+            if ex.response.status_code == 404:
+                out.notfound(path)
             else:
                 raise
 
-    def _printroot(self):
-        with urlopen(self._PROFILE) as f:
-            data = json.load(f)
+    @staticmethod
+    def _getjson(url, ttl=None):
+        response = session.get(url, ttl=ttl)
+        response.raise_for_status()
+        with trace.span("parse"):
+            return response.json()
+
+    def _printroot(self, out):
+        data = self._getjson(self._PROFILE, self.TTL["profile"])
 
         ts = self._datetots(data["date_joined"])
         for x in ["", "videos", "playlists", "shorts"]:
-            self._printentity("/" + x, ts)
+            out.entity("/" + x, time=ts)
 
-        self._printentity("/hashes", ts, True)
-        self._printbytes(f"/{data['name']}.txt", data["description"], ts)
-        self._printjson("/.info.json", data, ts)
+        out.entity("/hashes", time=ts, hide=True)
+        out.bytes(f"/{data['name']}.txt", data["description"], time=ts)
+        self.meta.json(out, "/.info.json", data, time=ts)
 
-    def _printthumbnail(self, path, data, ts=None):
+    def _printthumbnail(self, out, path, data, ts=None):
         thumbnail_url = data["thumbnail_url"]
-        name = "thumbnail." + thumbnail_url.split(".")[-1]
-        self._printurl(os.path.join(path, name), thumbnail_url, ts)
+        name = os.path.join(path, "thumbnail." + thumbnail_url.split(".")[-1])
+        if session.blobs is not None:
+            self.meta.defer(out, name, lambda x: session.serveblob(x, name, thumbnail_url, time=ts), time=ts)
+        else:
+            out.url(name, thumbnail_url, time=ts)
 
-    def _printvideo(self, path, data):
+    def _printvideo(self, out, path, data):
         pubts = self._datetots(data["publication_ts"])
-        self._printbytes(path + "/origin.m3u8", data["video_url"], pubts)
-        self._printbytes(path + "/about.txt", data["description"], pubts)
-        self._printthumbnail(path, data, pubts)
-        self._printentity(path + "/video.m3u8", pubts)
-        self._printentity(path + "/.info.json", pubts)
+        out.bytes(path + "/origin.m3u8", data["video_url"], time=pubts)
+        out.bytes(path + "/about.txt", data["description"], time=pubts)
+        self._printthumbnail(out, path, data, pubts)
+        out.entity(path + "/video.m3u8", time=pubts)
+        out.entity(path + "/.info.json", time=pubts)
 
-    def _printoptions(self, path, videoid):
-        with urlopen(self._PLAYOPTIONS.format(videoid)) as f:
-            data = json.load(f)
+    def _printoptions(self, out, path, videoid):
+        data = self._getjson(self._PLAYOPTIONS.format(videoid), self.TTL["options"])
 
-        self._printjson(path + "/.info.json", data)
-        self._printbytes(path + "/video.m3u8", data["video_balancer"]["m3u8"])
+        out.json(path + "/.info.json", data)
+        out.bytes(path + "/video.m3u8", data["video_balancer"]["m3u8"])
 
-    def _printcommon(self, url, path):
-        with urlopen(url) as f:
-            data = json.load(f)
+    def _printcommon(self, out, url, path):
+        data = self._getjson(url, self.TTL["page"])
+        self._printresults(out, path, data)
 
+    def _printresults(self, out, path, data):
         for val in data["results"]:
             title = val["title"].replace("/", ",")
             ppath = "/hashes/" + str(val["id"])
-            if "publication_ts" in val:
-                ts = self._datetots(val["publication_ts"])
-            else:
-                ts = self._datetots(val["created_ts"])
-
-            self._printlink(os.path.join(path, title), ppath, ts)
-            if "videos_count" in val:
-                self._printthumbnail(ppath, val, ts)
-                self._printbytes(ppath + "/playlist.m3u8", f"{self.BASEURL}/plst/{val['id']}/", ts)
-                self._printentity(ppath + "/videos", ts)
-            else:
-                self._printvideo(ppath, val)
+            out.link(os.path.join(path, title), ppath, time=self._itemts(val))
+            self._printitem(out, ppath, val)
 
         if data["has_next"]:
-            self._printentity(path + "/next")
+            out.entity(path + "/next")
 
-        self._printjson(path + "/.info.json", data)
+        self.meta.json(out, path + "/.info.json", data)
+
+    def _printitem(self, out, ppath, val):
+        if "videos_count" in val:
+            ts = self._itemts(val)
+            self._printthumbnail(out, ppath, val, ts)
+            out.bytes(ppath + "/playlist.m3u8", f"{self.BASEURL}/plst/{val['id']}/", time=ts)
+            out.entity(ppath + "/videos", time=ts)
+        else:
+            self._printvideo(out, ppath, val)
+
+    def _sync(self, section):
+        if section in self.synced:
+            return
+
+        complete = self.index.complete(section)
+        url = self._sections()[section]
+        # sync pages skip the response cache, an update reads them one by one up to the first known item
+        pages = self._sequential(url) if complete else self._pages(url, None)
+        for data in pages:
+            fresh = [x for x in data["results"] if not self.index.contains(section, str(x["id"]))]
+            self.index.add(section, [(str(x["id"]), self._itemts(x), x) for x in fresh])
+            if complete and len(fresh) < len(data["results"]):
+                break
+        else:
+            self.index.markcomplete(section)
 
-    def _printplaylist(self, path, playlistid):
-        self._printcommon(f"{self.BASEURL}/api/playlist/custom/{playlistid}/videos/", path)
+        self.synced.add(section)
+
+    def _printindexed(self, out, section, path):
+        self._sync(section)
+        self._printresults(out, path, dict(results=self.index.items(section), has_next=False))
+
+    def _printhash(self, out, path, itemid):
+        if (val := self.index.get(itemid)) is not None:
+            self._printitem(out, path, val)
+        else:
+            out.notfound(path)
+
+    def _printplaylist(self, out, path, playlistid):
+        if self.flat:
+            self._printflat(out, self._PLAYLISTVIDEOURL.format(playlistid, "{}"), path)
+        else:
+            self._printcommon(out, f"{self.BASEURL}/api/playlist/custom/{playlistid}/videos/", path)
+
+    @staticmethod
+    def _numpages(data):
+        if "num_pages" in data:
+            return data["num_pages"]
+        elif data.get("count") is not None and data.get("per_page"):
+            return -(-data["count"] // data["per_page"])
+        else:
+            return None
+
+    def _sequential(self, url):
+        for pagenum in itertools.count(1):
+            data = self._getjson(url.format(pagenum))
+            yield data
+            if not data["has_next"]:
+                break
+
+    def _pages(self, url, ttl=TTL["page"]):
+        first = self._getjson(url.format(1), ttl)
+        yield first
+        if not first["has_next"]:
+            return
+
+        numpages = self._numpages(first)
+        pages = range(2, numpages + 1) if numpages is not None else itertools.count(2)
+        def fetch(pagenum):
+            return self._getjson(url.format(pagenum), ttl)
+
+        for data in pool.imap(fetch, pages, self.workers):
+            yield data
+            if not data["has_next"]:
+                break
+
+    def _printflat(self, out, url, path):
+        results = []
+        for data in self._pages(url):
+            results += data["results"]
+
+        self._printresults(out, path, dict(results=results, has_next=False))
 
     @staticmethod
     def extractIdFromUrl(url):
         reg = re.compile(r'"userChannelId":\s*(\d+)')
         try:
-            with urlopen(url) as f:
-                for line in f:
-                    if m := reg.search(line.decode()):
+            with session.get(url, stream=True) as f:
+                f.raise_for_status()
+                for line in f.iter_lines(decode_unicode=True):
+                    if m := reg.search(line):
                         return m[1]
                 else:
                     return None
         except HTTPError as ex:
-            if ex.code == 404:
+            if ex.response.status_code == 404:
                 return None
             else:
                 raise
@@ -167,7 +291,7 @@ class Fetcher:
         return Fetcher.extractIdFromUrl(f"{Fetcher.BASEURL}/u/{slug}")
 
 
-def main():
+def argparser():
     lst = {"RuTube": 23704195, "karpavichus": 37213454, "animach": 32420212, "repich": 32427511, "science": 164395}
     epilog = ", ".join(f"{k} ({v})" for k, v in lst.items())
     parser = argparse.ArgumentParser(description="Rutube api handler", epilog="Some channels: " + epilog)
@@ -175,34 +299,52 @@ def main():
     parser.add_argument("-s", "--slug", help="Connect by user slug")
     parser.add_argument("-u", "--url", help="Connect by user url")
     parser.add_argument("-p", "--print", help="Just print user id", action="store_true")
-    args = parser.parse_args()
-
+    parser.add_argument("-f", "--flat", help="List all pages of a section as one directory", action="store_true")
+    parser.add_argument("-w", "--workers", help="Pages to request in parallel in flat mode", type=int, default=4)
+    parser.add_argument("-i", "--index-dir", help="Keep a synced index of the channel in this directory")
+    protocol.add_arguments(parser)
+    session.add_arguments(parser)
+    trace.add_arguments(parser)
+    engine.add_arguments(parser)
+    warmup.add_arguments(parser)
+    return parser
+
+
+def resolveuserid(args):
     if args.userid is not None:
-        userid = args.userid
+        return args.userid
     elif args.slug is not None:
-        userid = Fetcher.extractIdFromSlug(args.slug)
+        return Fetcher.extractIdFromSlug(args.slug)
     elif args.url is not None:
-        userid = Fetcher.extractIdFromUrl(args.url)
+        return Fetcher.extractIdFromUrl(args.url)
     else:
+        return None
+
+
+def create(args):
+    if (userid := resolveuserid(args)) is None:
+        raise ValueError("UserId is not found")
+
+    return Fetcher(userid, args.flat, args.workers, args.index_dir, args.lazy_meta)
+
+
+def main():
+    args = argparser().parse_args()
+    session.configure(args)
+    trace.configure(args)
+
+    if args.userid is None and args.slug is None and args.url is None:
         print("Incorrect usage, see --help", file=sys.stderr)
         sys.exit(1)
 
     if args.print:
-        if userid is None:
+        if (userid := resolveuserid(args)) is None:
             print("UserId is not found")
             sys.exit(2)
         else:
             print(userid)
     else:
-        fetcher = Fetcher(userid)
-        try:
-            for path in sys.stdin:
-                path = path.strip()
-                fetcher.fetch(path)
-                print("eom")
-                sys.stdout.flush()
-        except KeyboardInterrupt:
-            pass
+        engine.serve(warmup.create(create(args), args), limit=args.pipeline)
 
 
 if __name__ == "__main__":